@@ -0,0 +1,170 @@
+from time import time
+
+import cv2
+import numpy as np
+
+
+class BackgroundModel:
+    """Base class for the background models used by CamMovement.
+    Every model takes the preprocessed (downscaled, blurred, grayscaled) frames and returns a binary foreground mask
+    where the changed pixels are 255
+
+    Attributes:
+        threshold : the minimum difference from the background for a pixel to be foreground, (0,255)
+        adaptive : True if the model updates itself, so background changes do not need a reset
+        apply_calls : the number of frames processed
+        apply_time : the seconds spent processing them
+
+    """
+
+    adaptive = False
+
+    def __init__(self, threshold=75):
+        self.threshold = threshold
+        self.apply_calls = 0
+        self.apply_time = 0
+
+    def reset(self, gray):
+        """Use gray as the new background"""
+        raise NotImplementedError
+
+    def apply(self, gray, learn=True):
+        """Return the foreground mask of gray, if learn is True update the model too"""
+
+        start = time()
+        mask = self.foreground(gray, learn)
+
+        self.apply_time += time() - start
+        self.apply_calls += 1
+
+        return mask
+
+    def foreground(self, gray, learn):
+        """Compute the foreground mask, implemented by the models"""
+        raise NotImplementedError
+
+    def background(self):
+        """Return the current background image"""
+        raise NotImplementedError
+
+    def cost(self):
+        """Return the average milliseconds per frame"""
+        if not self.apply_calls:
+            return 0
+        return 1000 * self.apply_time / self.apply_calls
+
+
+class StaticBackground(BackgroundModel):
+    """A single background image, changed only by reset (the ground image)"""
+
+    def __init__(self, threshold=75):
+        BackgroundModel.__init__(self, threshold)
+        self.ground = None
+
+    def reset(self, gray):
+        self.ground = gray
+
+    def foreground(self, gray, learn):
+        delta = cv2.absdiff(self.ground, gray)
+        return cv2.threshold(delta, self.threshold, 255, cv2.THRESH_BINARY)[1]
+
+    def background(self):
+        return self.ground
+
+
+class RunningAverageBackground(BackgroundModel):
+    """A background updated with a running average of the frames. The foreground pixels are learned slower than the
+    background ones so that still people are not absorbed right away, while light changes are
+
+    Attributes:
+        alpha : the learning rate for the background pixels
+        foreground_alpha : the learning rate for the foreground pixels
+        average : the float background image
+
+    """
+
+    adaptive = True
+
+    def __init__(self, threshold=75, alpha=0.02, foreground_alpha=0.002):
+        BackgroundModel.__init__(self, threshold)
+        self.alpha = alpha
+        self.foreground_alpha = foreground_alpha
+        self.average = None
+
+    def reset(self, gray):
+        self.average = gray.astype(np.float32)
+
+    def foreground(self, gray, learn):
+        delta = cv2.absdiff(self.average, gray.astype(np.float32))
+        mask = cv2.threshold(delta, self.threshold, 255, cv2.THRESH_BINARY)[1].astype(np.uint8)
+
+        if learn:
+            cv2.accumulateWeighted(gray, self.average, self.alpha, mask=cv2.bitwise_not(mask))
+            cv2.accumulateWeighted(gray, self.average, self.foreground_alpha, mask=mask)
+
+        return mask
+
+    def background(self):
+        return cv2.convertScaleAbs(self.average)
+
+
+class SubtractorBackground(BackgroundModel):
+    """Wrapper for the OpenCV background subtractors, they use their own statistical thresholds instead of threshold
+
+    Attributes:
+        subtractor : the OpenCV BackgroundSubtractor
+        learning_rate : the subtractor learning rate, -1 lets OpenCV choose it from the history length
+
+    """
+
+    adaptive = True
+
+    def __init__(self, threshold=75, learning_rate=-1):
+        BackgroundModel.__init__(self, threshold)
+        self.learning_rate = learning_rate
+        self.subtractor = self.create()
+
+    def create(self):
+        """Return a new subtractor"""
+        raise NotImplementedError
+
+    def reset(self, gray):
+        self.subtractor = self.create()
+        self.subtractor.apply(gray, learningRate=1)
+
+    def foreground(self, gray, learn):
+        return self.subtractor.apply(gray, learningRate=self.learning_rate if learn else 0)
+
+    def background(self):
+        return self.subtractor.getBackgroundImage()
+
+
+class MOG2Background(SubtractorBackground):
+    """Gaussian mixture background (cv2.createBackgroundSubtractorMOG2)"""
+
+    def create(self):
+        return cv2.createBackgroundSubtractorMOG2(history=500, varThreshold=16, detectShadows=False)
+
+
+class KNNBackground(SubtractorBackground):
+    """K nearest neighbours background (cv2.createBackgroundSubtractorKNN)"""
+
+    def create(self):
+        return cv2.createBackgroundSubtractorKNN(history=500, dist2Threshold=400, detectShadows=False)
+
+
+BACKGROUND_MODELS = {
+    "static": StaticBackground,
+    "average": RunningAverageBackground,
+    "mog2": MOG2Background,
+    "knn": KNNBackground,
+}
+
+
+def make_background_model(name, threshold=75):
+    """Build the background model called name, one of the BACKGROUND_MODELS keys"""
+
+    if name not in BACKGROUND_MODELS:
+        raise ValueError("Unknown background model " + str(name))
+
+    return BACKGROUND_MODELS[name](threshold)
@@ -1,9 +1,11 @@
+import io
 import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
 import os
 import cv2
-from time import sleep
+from time import sleep, time
 import datetime
 import logging
 
@@ -11,7 +13,14 @@ import sys
 #from memory_profiler import profile
 import numpy as np
 
+from Background_models import make_background_model
+from Event_pipeline import EventPipeline, SessionWorker
+from Face_quality import FaceQuality
 from Face_recognizer import FaceRecognizer
+from Frame_buffer import FrameRing, MemoryBudget, PreRollBuffer, RecordingSession, SessionCompressor
+from Frame_sources import make_source
+from Trackers import FaceTracker, MotionTracker
+from Video_encoder import EncodingPolicy, VideoEncoder
 from utils import time_profiler
 
 logger = logging.getLogger('motionlog')
@@ -28,7 +37,7 @@ class MainClass:
 
         telegram_handler: the class that is in control of notifying the users about changes
 
-        frames : a list of frames from which get the camera frames
+        frames : the ring of frames from which get the camera frames
         shotter : the class that takes frames from the camera
 
         face_recognizer : the class that handles the face recognition part
@@ -47,7 +56,7 @@ class MainClass:
         self.telegram_handler = TelegramHandler(self.bot)
         self.telegram_handler.start()
 
-        self.frames = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
+        self.frames = FrameRing(capacity=10, shape=(480, 640, 3))
         self.shotter = CamShotter(self.frames)
         self.shotter.start()
 
@@ -62,13 +71,13 @@ class MainClass:
         """Capture a frame from the camera
         """
         # print("taking image")
-        img = self.frames[-2]
+        record = self.frames.copy()
 
-        if isinstance(img, int):
+        if record is None:
             print("empty queue")
             return False
         # try to save the image
-        return cv2.imwrite(image_name, img)
+        return cv2.imwrite(image_name, record.bgr)
 
     def stop(self):
         """Stop the execution of the threads and exit"""
@@ -90,25 +99,50 @@ class MainClass:
         frame_width = 640
         frame_height = 480
         fps = 20
-        # print("initializing writer")
 
-        out = cv2.VideoWriter(video_name, 0x00000021, fps, (frame_width, frame_height))
-
-        # print("writer initialized")
-
-        # start capturing frames
-        self.shotter.capture(True)
+        # start capturing frames, the encoder writes them while they are captured
+        recording = self.shotter.capture(True)
+        self.motion.video_encoder.encode(recording, video_name, fps, (frame_width, frame_height),
+                                         seconds=seconds + self.shotter.preroll_seconds)
         # sleep
         sleep(seconds)
-        # get catured frames
+        # stop capturing and wait for the last frames to be written
         to_write = self.shotter.capture(False)
-        # write frame to file and release
-        for elem in to_write:
-            out.write(elem)
-        out.release()
+        self.motion.video_encoder.wait(to_write)
+        to_write.close()
 
         self.telegram_handler.send_video(video_name, user_id,str(seconds) + " seconds record")
 
+    def stats(self):
+        """Return a string with the performance metrics of the threads"""
+
+        to_send = "<b>Recording</b>\n"
+        to_send += "Last recording : " + self.shotter.last_recording_stats + "\n"
+        to_send += "Pre-roll : " + self.shotter.preroll.stats() + "\n"
+
+        bk_model = self.motion.bk_model
+        to_send += "\n<b>Motion</b>\n"
+        to_send += "Background model : " + self.motion.bk_model_type + ", " + str(
+            round(bk_model.cost(), 2)) + " ms per frame\n"
+
+        to_send += "Event queue : " + self.motion.pipeline.stats() + "\n"
+        to_send += "Last video : " + self.motion.video_encoder.last_stats + "\n"
+
+        quiet = self.motion.score_stats["quiet"]
+        contours = self.motion.score_stats["contours"]
+        to_send += "Frames scored : " + str(quiet + contours) + ", quiet " + str(quiet) + ", contours " + str(
+            contours) + "\n"
+
+        face_stats = self.motion.face_stats
+        to_send += "\n<b>Faces</b>\n"
+        to_send += "Frames searched : whole " + str(face_stats["full"]) + ", motion regions " + str(
+            face_stats["roi"]) + ", skipped " + str(face_stats["skipped"]) + "\n"
+        to_send += "Last event : " + self.motion.last_face_scan + "\n"
+        to_send += "Known subjects : " + self.face_recognizer.registry.stats() + "\n"
+        to_send += "Model : " + self.face_recognizer.model_stats() + "\n"
+        to_send += "Training : " + self.face_recognizer.train_stats + "\n"
+
+        return to_send
 
     def predict_face(self, img_path):
         """
@@ -157,22 +191,37 @@ class MainClass:
 
 
 class CamShotter(Thread):
-    """Class to take frames from camera, it is the only one who has access to the VideoCapture ojbect
+    """Class to take frames from camera, it is the only one who has access to the frame source
 
     Attributes:
         stop_event : the event used to stop the class
+        source_type : where to take the frames from, one of device (the camera), video (a recorded video file),
+            images (a directory of images) or synthetic (generated moving objects, for testing without a camera)
         cam_idx : the camera index, usually 0
-        CAM : the videoCapture object to take frames from the camera
-        queue : a list of frames shared between the classes
+        source_path : the video file or the image directory for the video and images sources
+        source_speed : the playback speed of the recorded sources, 0 plays them as fast as possible
+        source : the FrameSource to take frames from
+        queue : the FrameRing shared between the classes, frames are read directly into its slots
         capture_bool : a flag value to start/stop/capturing all frames from the camera
-        capture_queue : the list that will be holding all the frames
+        capture_queue : the RecordingSession that will be holding all the frames
+        record_max_raw_bytes : the memory budget for the uncompressed frames of a recording
+        record_max_bytes : the maximum bytes held by a recording, after that the frames are dropped
+        record_overflow : what to do once the raw budget is exceeded, jpeg (compress in memory), disk (compress on disk)
+            or decimate (keep one frame every few)
+        compressor : the SessionCompressor compressing the recorded frames on its own thread, off the camera loop
+        record_memory_bytes : the memory all the recordings alive (recording or waiting to be processed) can hold
+        memory_budget : the MemoryBudget of the recordings, shared with the EventPipeline
+        last_recording_stats : the metrics of the last recording
+        preroll_seconds : the seconds of frames before the start of a recording that are put at its beginning
+        preroll_max_bytes : the memory budget for the pre-roll frames, which are kept jpeg compressed
+        preroll : the PreRollBuffer compressing the last frames on its own thread
         lock : a lock object to lock the capture_queue
         camera_connected : a flag to notify the others thread that the camera is connected and they can start taking
         frames from the queue
 
     """
 
-    def __init__(self, queue):
+    def __init__(self, queue, source=None):
 
         # init the thread
         Thread.__init__(self)
@@ -180,11 +229,28 @@ class CamShotter(Thread):
         self.stop_event = threading.Event()
 
         # get camera and queue
+        self.source_type = "device"
         self.cam_idx = 0
-        self.CAM = cv2.VideoCapture(self.cam_idx)
+        self.source_path = ""
+        self.source_speed = 1
         self.queue = queue
+
+        if source is None:
+            source = make_source(self.source_type, queue.shape, path=self.source_path, cam_idx=self.cam_idx,
+                                 speed=self.source_speed)
+        self.source = source
         self.capture_bool = False
-        self.capture_queue = []
+        self.record_max_raw_bytes = 64 * 2 ** 20
+        self.record_max_bytes = 128 * 2 ** 20
+        self.record_overflow = "jpeg"
+        self.compressor = SessionCompressor()
+        self.record_memory_bytes = 256 * 2 ** 20
+        self.memory_budget = MemoryBudget(self.record_memory_bytes)
+        self.capture_queue = self.new_recording()
+        self.last_recording_stats = "no recordings yet"
+        self.preroll_seconds = 2
+        self.preroll_max_bytes = 4 * 2 ** 20
+        self.preroll = PreRollBuffer(queue, seconds=self.preroll_seconds, max_bytes=self.preroll_max_bytes)
         self.lock = threading.Lock()
         self.camera_connected = False
 
@@ -193,23 +259,32 @@ class CamShotter(Thread):
     def run(self):
         """Main thread loop"""
 
+        # start compressing the frames for the pre-roll and the recordings
+        self.preroll.start()
+        self.compressor.start()
+
         while True:
 
             # if the thread has been stopped
             if self.stopped():
-                # release the cam object
-                self.CAM.release()
+                # stop the compressors and release the cam object
+                self.preroll.stop()
+                self.preroll.join()
+                self.compressor.stop()
+                self.compressor.join()
+                self.source.release()
                 sleep(1)
-                # delete the queue
-                del self.queue[:]
+                # empty the queue
+                self.queue.clear()
                 # log and return
                 logger.info("Stopping Cam shotter")
                 return
 
-            # read frame form camera
-            ret, img = self.CAM.read()
+            # read frame form camera directly into the next slot of the ring
+            slot = self.queue.next_slot()
+            ret, img = self.source.read(slot)
 
-            # if frame has been read correctly add it to the end of the list
+            # if frame has been read correctly commit it to the ring
             if ret:
                 # if it is the first time that the class reads an image
                 if not self.camera_connected:
@@ -217,26 +292,13 @@ class CamShotter(Thread):
                     logger.debug("Camera connected")
                     self.camera_connected = True
                     # sleep to wait for auto-focus/brightness
-                    sleep(3)
-
-                #grayscale the future last frame
-                try:
-                    gray=self.queue[1]
-                    self.queue[1]=cv2.cvtColor(gray,cv2.COLOR_BGR2GRAY)
-                except cv2.error as e:
-                    #error_log = "Cv Error: " + str(e)
-                    #print(error_log)
-                    pass
+                    sleep(self.source.warmup)
 
-
-                # pop first element
-                self.queue.pop(0)
-
-
-                # append image at last
-                self.queue.append(img)
+                # commit the image
+                seq = self.queue.commit(img)
+                # the slot will be reused, so the session copies the captured frames
                 if self.capture_bool:
-                    self.capture_queue.append(img)
+                    self.capture_queue.add(self.queue.get(seq))
 
 
                 # print("saved")
@@ -248,45 +310,53 @@ class CamShotter(Thread):
             # sleep(0.01)
 
     def capture(self, capture):
-        """Start/stop the frame capturing"""
+        """Start/stop the frame capturing, return the RecordingSession the frames are captured into. When starting the
+        session is still being filled, so it can be followed while recording"""
 
         try:
             # if you want to capture the video
             if capture:
-                # acquire the lock, empty the list and set the flag to true
+                # acquire the lock, start a new session with the pre-roll frames and set the flag to true
                 self.lock.acquire()
-                self.capture_queue = []
+                self.capture_queue = self.new_recording()
+                self.preroll.fill(self.capture_queue)
                 self.capture_bool = True
+                return self.capture_queue
             else:
-                # otherwise set the flag to false and release the lock
+                # otherwise set the flag to false, end the session and release the lock
                 self.capture_bool = False
+                self.capture_queue.end()
+                self.last_recording_stats = self.capture_queue.stats()
+                logger.info("Recording ended : " + self.last_recording_stats)
                 self.lock.release()
                 return self.capture_queue
         except:
             self.lock.release()
 
+    def new_recording(self):
+        """Return an empty RecordingSession with the shotter budget"""
+        return RecordingSession(max_raw_bytes=self.record_max_raw_bytes, max_bytes=self.record_max_bytes,
+                                overflow=self.record_overflow, compressor=self.compressor, budget=self.memory_budget)
+
     def reopen_cam(self):
         """Function to reopen the camera"""
-        # release the camera
-        self.CAM.release()
-        sleep(2)
-        # capture stream
-        self.CAM = cv2.VideoCapture(self.cam_idx)
-        sleep(2)
-        # chech if camera is opened
-        self.check_open_cam()
+        self.source.reopen()
 
     def close_cam(self):
         """Function to release teh camera stream"""
         # print("close cam")
-        self.CAM.release()
+        self.source.release()
 
     def check_open_cam(self):
         """Function to open the camera stream"""
         # print("checking cam")
-        if not self.CAM.isOpened():
+        if not self.source.is_opened():
             # print("cam was closed")
-            self.CAM.open(0)
+            self.source.reopen()
+
+    def wait_for_frame(self, after_seq, timeout=None):
+        """Block until a frame newer than after_seq is captured and return its FrameRecord, None on timeout"""
+        return self.queue.wait_for_frame(after_seq, timeout)
 
     def stop(self):
         """Stop the thread"""
@@ -303,26 +373,54 @@ class CamMovement(Thread):
     Attributes:
 
         shotter : the cam_shotter object
-        frame: the queue used by the shotter class
+        frame: the FrameRing used by the shotter class
 
         telegram_handler : the telegram handler class
 
         face_recognizer: the face recognizer class
 
         delay : used delay between movement detection
+        last_seq : the sequence number of the last frame analyzed, so that no frame is analyzed twice
+        frame_timeout : the seconds to wait for a new frame before giving up
         min_area : the minimum area of changes detected to be considered an actual change in the image
         ground_frame : the image used as the background to be compared with the current frames
+        bk_model_type : the background model, one of static (the ground image), average (running average), mog2, knn
+        bk_model : the BackgroundModel giving the foreground of the frames, use set_background_model to change it
         blur : the mean shift of the blur for the preprocessing of the images
+        analysis_resolution : the (width,height) the frames are downscaled to before looking for movement. min_area, blur
+            and dilate_window_size are given for the full resolution and scaled automatically, the contours are in
+            analysis coordinates, use motion_boxes to get them in frame coordinates
 
+        frontal_face_path : the path of the frontal face cascade
         frontal_face_cascade : the object that detects frontal faces
+        thread_cascades : the frontal face cascades of the other threads, the cascades must not be shared between threads
         profile_face_cascade : the object that detects frontal faces
         face_size : the minimum window size to look for faces, the bigger the faster the program gets. But for distant
             people small values are to be taken into account
+        face_roi_padding : the recorded frames are searched for faces only around the movement, whose boxes are padded
+            by this fraction of their size (and at least face_size) so that the whole head is in them
+        full_scan_every : one recorded frame every full_scan_every is searched whole anyway, so faces still for a while
+            are not missed
+        face_workers : the number of threads searching the frames for faces at once, the cascade releases the GIL so
+            they run on different cores
+        face_pool : the ThreadPoolExecutor of the face workers
+        face_detect_every : when greater than 1 the cascade runs one recorded frame every face_detect_every (or when a
+            face is lost) and the faces are tracked with template matching in the frames between, faster but the new
+            faces are found a few frames later
+        last_face_scan : the face detection metrics of the last event (detector calls per frame)
+        face_stats : how many frames have been searched whole, only in the motion regions or skipped since there was
+            no movement
+        last_motion_boxes : the motion boxes, in frame coordinates, of the last frame checked by are_different (None
+            when unknown)
+        last_motion_cnts : the contours, in analysis coordinates, of the last frame checked by are_different
+        motion_tracker : the MotionTracker following the moving objects of an event, their trajectories are in the
+            summary of the recording
+        min_track_frames : the objects seen in fewer frames are not in the event summary
 
         max_seconds_retries : if a movement is detected for longer than max_seconds_retries the program will check for a
         background change, do not increase this parameter to much since it will slow down tremendously the program execution
 
-        video_name : the name of the video to be send throught telegram
+        video_name : the name of the video to be send throught telegram, the event number is added to it
         resolution : the resolution of the video, do not change or telegram will not recognize the video as a gif
         fps : the frame per second of the video, higher values will result in slightly slower computation and more of a
             time loop video. Lower values will speed up the program (from 30 to 20 will give you a 25% speedup PER FUNCTION
@@ -335,10 +433,29 @@ class CamMovement(Thread):
         debug_flag : flag used to check if the user want to recieve the debug images (can be set by telegram , it slows down the program)
         face_reco_falg : flag used to check if the user want to recieve the predicted face with the photo (can be set by telegram)
 
-        faces_cnts : list of contours for detected faces
+        face_scanner : the FaceScanner detecting the faces in the recorded frames while the movement goes on
+        video_encoder : the VideoEncoder writing the videos of the events while they are recorded
+        max_video_bytes : the maximum size of the event videos, they are downscaled and decimated if they may be bigger
+        uplink_rate : the upload speed in bytes per second (0 if unknown), when known the videos are kept small enough to
+            be uploaded in max_upload_seconds
+        max_upload_seconds : the maximum seconds to upload a video
+        pipeline : the EventPipeline post-processing the motion events while the detection goes on
+        event_workers : the number of events that can be post-processed at once
+        max_events : the maximum number of events that can wait for a worker, they are bound by the memory budget of the
+            shotter first
+        sheet_sender : the ContactSheetSender sending the contact sheets as soon as the movement ends
+        keyframes : the number of frames of the contact sheet sent as soon as the movement ends, before the video
+        keyframe_columns : the number of frames per row of the contact sheet
+        keyframe_width : the width of the frames in the contact sheet
+        keyframe_quality : the jpeg quality (0-100) of the contact sheet
+        face_quality : the FaceQuality scoring the face crops
+        top_faces : the number of best crops of every face (followed across the frames) given to the recognizer, the
+            others are discarded
         max_blurrines : the maximum threshold for blurriness detection, discard face images with blur>max_blurrines
         min_bk_threshold : the minimum difference in the background grayscaled image for the movement to be detected. When high
             only the bigger black/white difference will be detected. The range is (0,255) which is the intensity of the pixel
+        score_decimation : count the changed pixels on one pixel every score_decimation per axis, faster but approximate
+        score_stats : how many frames have been found quiet by counting the changed pixels and how many needed the contours
 
     """
 
@@ -355,15 +472,26 @@ class CamMovement(Thread):
         self.face_recognizer = face_recognizer
 
         self.delay = 0.1
+        self.last_seq = -1
+        self.frame_timeout = 1
         self.min_area = 2000
         self.ground_frame = 0
         self.blur = (10, 10)
+        self.analysis_resolution = (320, 240)  # width,height
 
-        self.frontal_face_cascade = cv2.CascadeClassifier(
-            '/home/pi/InstallationPackages/opencv-3.1.0/data/lbpcascades/lbpcascade_frontalface.xml')
+        self.frontal_face_path = '/home/pi/InstallationPackages/opencv-3.1.0/data/lbpcascades/lbpcascade_frontalface.xml'
+        self.frontal_face_cascade = cv2.CascadeClassifier(self.frontal_face_path)
+        self.thread_cascades = threading.local()
         self.profile_face_cascade = cv2.CascadeClassifier(
             '/home/pi/InstallationPackages/opencv-3.1.0/data/lbpcascades/lbpcascade_profileface.xml')
         self.face_size=50
+        self.face_roi_padding = 0.3
+        self.full_scan_every = 10
+        self.face_detect_every = 1
+        self.face_workers = 3
+        self.face_pool = ThreadPoolExecutor(max_workers=self.face_workers)
+        self.last_face_scan = "no events yet"
+        self.face_stats = {"full": 0, "roi": 0, "skipped": 0}
 
         self.max_seconds_retries = 10
 
@@ -379,12 +507,40 @@ class CamMovement(Thread):
         self.green_squares=False
 
         self.resetting_ground = False
-
-        self.faces_cnts=[]
+        self.ground_ready = threading.Event()
+
+        self.face_scanner = FaceScanner(self)
+        self.max_video_bytes = 4 * 2 ** 20
+        self.uplink_rate = 0
+        self.max_upload_seconds = 20
+        self.video_encoder = VideoEncoder(policy=EncodingPolicy(self.max_video_bytes, self.uplink_rate,
+                                                                self.max_upload_seconds))
+
+        self.event_workers = 2
+        self.max_events = 16
+        self.pipeline = EventPipeline(self.process_event, workers=self.event_workers, max_events=self.max_events,
+                                      budget=shotter.memory_budget, min_free=shotter.record_max_raw_bytes)
+        self.sheet_sender = ContactSheetSender(self)
+        self.keyframes = 6
+        self.keyframe_columns = 3
+        self.keyframe_width = 240
+        self.keyframe_quality = 80
+        self.face_quality = FaceQuality(good_size=2 * self.face_size)
+        self.top_faces = 3
         self.max_blurrines=100
         self.min_bk_threshold=75
         self.dilate_window_size=(17,13)
 
+        self.score_decimation = 1
+        self.score_stats = {"quiet": 0, "contours": 0}
+        self.last_motion_boxes = None
+        self.last_motion_cnts = []
+        self.motion_tracker = MotionTracker()
+        self.min_track_frames = 3
+
+        self.bk_model_type = "static"
+        self.bk_model = make_background_model(self.bk_model_type, self.min_bk_threshold)
+
         logger.debug("Cam_movement started")
 
     def run(self):
@@ -393,14 +549,19 @@ class CamMovement(Thread):
         while not self.shotter.camera_connected:
             sleep(0.5)
 
-        # wait for the frame queue to be full
-        initial_frame = self.frame[-1]
-        while isinstance(initial_frame, int):
-            initial_frame = self.frame[-1]
+        # wait for the first frame to be in the ring
+        while self.shotter.wait_for_frame(-1, self.frame_timeout) is None:
+            continue
 
         # get the background image and save it
         self.reset_ground("Background image")
 
+        # start the face scanner, the video encoder, the contact sheet sender and the event workers
+        self.face_scanner.start()
+        self.video_encoder.start()
+        self.sheet_sender.start()
+        self.pipeline.start()
+
         while True:
             try:
                 # detect a movement
@@ -419,6 +580,17 @@ class CamMovement(Thread):
     def stop(self):
         """Set the stop flag to true"""
         self.stop_event.set()
+        self.face_scanner.stop()
+        if self.face_scanner.is_alive():
+            self.face_scanner.join()
+        self.pipeline.stop()
+        self.video_encoder.stop()
+        if self.video_encoder.is_alive():
+            self.video_encoder.join()
+        self.sheet_sender.stop()
+        if self.sheet_sender.is_alive():
+            self.sheet_sender.join()
+        self.face_pool.shutdown(wait=False)
 
     def stopped(self):
         """Check for the flag value"""
@@ -431,15 +603,17 @@ class CamMovement(Thread):
         """
 
         # wait for resetting to be over
-        while self.resetting_ground:
-            continue
+        self.ground_ready.wait()
 
-        # get end frame after delay seconds
+        # get a new end frame after delay seconds
         sleep(self.delay)
-        end_frame = self.frame[0]
+        record = self.next_frame()
+        if record is None:
+            return
+        end_frame = record.gray
 
         # calculate diversity
-        score = self.are_different(self.ground_frame, end_frame)
+        score = self.are_different(None, end_frame)
         # if the notification is enable and there is a difference between the two frames and the ground is not resetting
         if self.motion_flag and score and not self.resetting_ground:
 
@@ -451,15 +625,46 @@ class CamMovement(Thread):
             if not self.video_flag:
                 return
 
-            # start saving the frames
-            self.shotter.capture(True)
-
-            # while the current frame and the initial one are different (aka some movement detected)
-            self.loop_difference(score, self.ground_frame, self.max_seconds_retries)
-
-            # save the taken frames
-            to_write = self.shotter.capture(False)
+            # start saving the frames, looking for faces while they are recorded
+            recording = self.shotter.capture(True)
+            try:
+                if recording is not None:
+                    # the faces are looked for where the movement is, the moving objects are followed from here
+                    self.motion_tracker.reset()
+                    self.record_motion(recording, record)
+                    if self.face_photo_flag:
+                        self.face_scanner.scan(recording)
+                    # and the video is written while recording
+                    self.video_encoder.encode(recording, self.event_video_name(recording), self.fps, self.resolution,
+                                              self.draw_frame, self.overlays_ready, self.max_event_seconds())
+
+                # while the current frame and the initial one are different (aka some movement detected)
+                self.loop_difference(score, None, self.max_seconds_retries, recording=recording)
+
+            finally:
+                # the shotter holds its lock until the capture is stopped, so stop it even when the loop failed
+                to_write = self.shotter.capture(False)
+                self.submit_event(to_write)
+
+    def submit_event(self, to_write):
+        """Send the contact sheet of the RecordingSession of a motion event and hand it to the event workers, so that
+        the detection can go on"""
+
+        to_write.summary["tracks"] = self.motion_tracker.all_tracks()
+        # a quick look at the event right away, without waiting for the events before it
+        self.sheet_sender.send(to_write)
+        if not self.pipeline.submit(to_write):
+            self.telegram_handler.send_message("Too many movements at once, the video has been dropped")
+            self.face_scanner.wait(to_write)
+            self.video_encoder.wait(to_write)
+            self.sheet_sender.wait(to_write)
+            to_write.close()
+
+    def process_event(self, to_write):
+        """Post-process the RecordingSession of a motion event: find the faces, draw on the frames and send everything.
+        It runs on the EventPipeline workers"""
 
+        try:
             # if the user wants the face in the movement
             if self.face_photo_flag:
                 # take the face
@@ -476,11 +681,133 @@ class CamMovement(Thread):
             # send the original video too
             if not self.resetting_ground:
                 print("Sending video...")
-                # draw on the frames  and send video
-                self.draw_on_frames(to_write)
-                self.telegram_handler.send_video(self.video_name)
+                # the video has been written while recording
+                video_name = self.video_encoder.wait(to_write)
+                if video_name is None:
+                    # draw on the frames
+                    video_name = self.event_video_name(to_write)
+                    self.draw_on_frames(to_write, video_name)
+                self.telegram_handler.send_video(video_name)
                 print("...video sent")
 
+        finally:
+            # free the recorded frames, once the scanner, the encoder and the sheet sender are done with them
+            self.face_scanner.wait(to_write)
+            self.video_encoder.wait(to_write)
+            self.sheet_sender.wait(to_write)
+            to_write.close()
+
+    def send_contact_sheet(self, frames):
+        """Send the keyframes of a RecordingSession tiled in a single jpeg, as soon as the movement ends"""
+
+        start = time()
+        indices = self.select_keyframes(frames)
+        if not indices:
+            return
+
+        sheet = self.contact_sheet(frames, indices)
+        logger.info("Contact sheet of event " + str(frames.event_id) + " with " + str(len(indices)) + " frames in " + str(
+            int(1000 * (time() - start))) + " ms")
+
+        self.telegram_handler.send_image(sheet, msg="Movement summary" + self.tracks_summary(frames),
+                                         image_name="contact_sheet_" + str(frames.event_id) + ".jpg",
+                                         params=[cv2.IMWRITE_JPEG_QUALITY, self.keyframe_quality])
+
+    def select_keyframes(self, frames):
+        """Return the indices, in time order, of up to keyframes frames of a RecordingSession. The frames with faces
+        come first, then the ones with the most movement, keeping them spread over the recording"""
+
+        seqs = frames.seqs()
+        if not seqs:
+            return []
+
+        scores = []
+        for idx, seq in enumerate(seqs):
+            motion = frames.motion_at(seq)
+            score = 0 if motion is None else motion["energy"]
+            # the faces found so far by the scanner, the energy is a fraction so they always win
+            if frames.meta[idx].get("faces") is not None:
+                score += 1
+            scores.append((score, idx))
+
+        min_distance = len(seqs) / (2 * self.keyframes)
+
+        chosen = []
+        for score, idx in sorted(scores, reverse=True):
+            if all(abs(idx - other) >= min_distance for other in chosen):
+                chosen.append(idx)
+                if len(chosen) == self.keyframes:
+                    break
+
+        return sorted(chosen)
+
+    def contact_sheet(self, frames, indices):
+        """Tile the frames with the given indices of a RecordingSession, keyframe_columns per row, with their faces
+        and capture time"""
+
+        width = self.keyframe_width
+        height = int(width * self.resolution[1] / self.resolution[0])
+
+        thumbs = []
+        for idx in indices:
+            record = frames.frame(idx)
+            scale = width / record.bgr.shape[1]
+            thumb = cv2.resize(record.bgr, (width, height), interpolation=cv2.INTER_AREA)
+
+            faces = frames.meta[idx].get("faces")
+            if faces is not None:
+                for (x, y, w, h) in faces:
+                    cv2.rectangle(thumb, (int(x * scale), int(y * scale)), (int((x + w) * scale), int((y + h) * scale)),
+                                  (0, 0, 255), 1)
+
+            # the path of the objects up to the frame
+            for track in self.summary_tracks(frames):
+                seqs = np.array([entry[0] for entry in track.history])
+                path = track.trajectory()[seqs <= record.seq] * scale
+                if len(path) > 1:
+                    cv2.polylines(thumb, [path.astype(np.int32)], False, (0, 255, 0), 1)
+
+            correct_date = datetime.datetime.fromtimestamp(record.timestamp) + datetime.timedelta(hours=1)
+            cv2.putText(thumb, correct_date.strftime("%H:%M:%S"), (5, height - 5), cv2.FONT_HERSHEY_TRIPLEX, 0.4,
+                        (0, 255, 255), 1)
+            thumbs.append(thumb)
+
+        # fill the last row
+        columns = min(self.keyframe_columns, len(thumbs))
+        while len(thumbs) % columns:
+            thumbs.append(np.zeros_like(thumbs[0]))
+
+        rows = [np.hstack(thumbs[i:i + columns]) for i in range(0, len(thumbs), columns)]
+        return np.vstack(rows)
+
+    def summary_tracks(self, frames):
+        """Return the objects followed during a recording, leaving out the ones seen in fewer than min_track_frames"""
+        return [track for track in frames.summary.get("tracks", []) if len(track.history) >= self.min_track_frames]
+
+    def tracks_summary(self, frames, max_tracks=5):
+        """Return the text describing the trajectories of the longest max_tracks objects of a recording"""
+
+        tracks = sorted(self.summary_tracks(frames), key=lambda track: track.duration(), reverse=True)[:max_tracks]
+
+        to_write = ""
+        for track in sorted(tracks, key=lambda track: track.track_id):
+            path = track.trajectory()
+            start = (int(path[0][0]), int(path[0][1]))
+            end = (int(path[-1][0]), int(path[-1][1]))
+            to_write += "\nObject " + str(track.track_id) + " : " + str(round(track.duration(), 1)) + " s from " + str(
+                start) + " to " + str(end) + ", " + self.direction_text(track.direction(len(track.history)))
+
+        return to_write
+
+    def max_event_seconds(self):
+        """Return the maximum length of an event recording: the pre-roll, the difference loop, the background check and
+        the retry"""
+        return self.shotter.preroll_seconds + self.max_seconds_retries + 3 + 1.5 + 1 + 1
+
+    def event_video_name(self, recording):
+        """Return the video name of a recording, every event has its own since more of them can be processed at once"""
+        return self.video_name.replace(".mp4", "_" + str(recording.event_id) + ".mp4")
+
     # =========================Movement=======================================
 
     def check_bk_changes(self, initial_frame, seconds):
@@ -495,18 +822,17 @@ class CamMovement(Thread):
         # setting initial frame
         #gray = cv2.cvtColor(initial_frame, cv2.COLOR_BGR2GRAY)
         # gray = cv2.GaussianBlur(gray, (21, 21), 0)
-        gray = cv2.blur(initial_frame, self.blur, 0)
+        gray = self.preprocess(initial_frame)
 
         # While there is movement
         while not score:
 
-            # take another frame
-            prov = self.frame[0]
-
-            #print(prov.shape)
+            # wait for another frame
+            record = self.next_frame()
 
             # check if images are different
-            score = self.are_different(gray, prov)
+            if record is not None:
+                score = self.are_different(gray, record.gray)
 
             # if time is exceeded exit while
             if (end - start).seconds > seconds:
@@ -519,9 +845,9 @@ class CamMovement(Thread):
 
         return False
 
-    def loop_difference(self, initial_score, initial_frame, seconds, retry=False):
+    def loop_difference(self, initial_score, initial_frame, seconds, retry=False, recording=None):
         """Loop until the current frame is the same as the ground image or time is exceeded, retry is used to
-        be make this approach robust to tiny changes"""
+        be make this approach robust to tiny changes. The movement found is kept in the recording session, if any"""
 
         if retry: print("retriyng")
         # take the time
@@ -531,74 +857,146 @@ class CamMovement(Thread):
         score = initial_score
         print("Start of difference loop")
 
+        prov = None
+
         # while there is some changes and the ground is not being resetted
         while score and not self.resetting_ground:
 
-            # take the already grayscaled frame
-            prov = self.frame[0]
-            #print(prov.shape)
+            # wait for a new frame
+            record = self.next_frame()
+            if record is not None:
+                prov = record.gray
 
-            # check if images are different
-            score = self.are_different(initial_frame, prov)
+                # check if images are different
+                score = self.are_different(initial_frame, prov)
+                if recording is not None:
+                    self.record_motion(recording, record)
 
             # if time is exceeded exit while
             if (end - start).seconds > seconds:
                 print("max seconds exceeded...checking for background changes")
-                if not retry:
+                # the adaptive models follow the background changes by themselves
+                if not retry and not self.bk_model.adaptive and prov is not None:
                     self.check_bk_changes(prov, 3)
                 print("End of difference loop")
                 return
 
             # update current time in while loop
             end = datetime.datetime.now()
-            sleep(0.05)
 
         # it may be that there is no apparent motion
         if not retry:
             # wait a little and retry
             sleep(1.5)
-            self.loop_difference(1, initial_frame, 1, True)
+            self.loop_difference(1, initial_frame, 1, True, recording)
 
         print("End of difference loop")
 
+    def record_motion(self, recording, record):
+        """Keep in the RecordingSession the movement are_different found in the frame record, with the objects the
+        motion tracker matched it to, so that the frames can be drawn on without analyzing them again"""
+
+        cnts = self.last_motion_cnts
+        objects = self.motion_tracker.update(record.seq, record.timestamp, self.last_motion_boxes or [])
+
+        # the direction of the biggest object, it stays the same while nothing moves
+        previous = recording.last_motion()
+        direction = None if previous is None else previous["direction"]
+        if objects:
+            biggest = max(objects, key=lambda track: track.box()[2] * track.box()[3])
+            direction = self.direction_text(biggest.direction())
+
+        # the fraction of the frame that changed
+        energy = sum(cv2.contourArea(c) for c in cnts) / (self.analysis_resolution[0] * self.analysis_resolution[1])
+
+        recording.add_motion(record.seq, {
+            "boxes": self.last_motion_boxes, "contours": cnts, "direction": direction, "energy": energy,
+            "objects": [(track.track_id, track.box(), self.direction_text(track.direction())) for track in objects]})
+
     def are_different(self, grd_truth, img2):
         """Return whenever the difference in area between the ground image and the frame is grather than the
-        threshold min_area."""
+        threshold min_area. If grd_truth is None the frame is compared with the background model.
+        Most of the frames are static, so the changed pixels are counted first and the contours are computed only when
+        there are enough of them to possibly make an area bigger than min_area.
+        The boxes and contours of the movement found are left in last_motion_boxes and last_motion_cnts"""
+
+        delta, thresh = self.compute_img_mask(grd_truth, img2)
+
+        # return true to not loose any movement
+        if thresh is None:
+            self.last_motion_boxes = None
+            self.last_motion_cnts = []
+            return True
+
+        # count the changed pixels, on a decimated image if asked
+        step = self.score_decimation
+        changed = cv2.countNonZero(thresh[::step, ::step]) * step * step
+
+        if changed < self.quiet_bound():
+            self.score_stats["quiet"] += 1
+            self.last_motion_boxes = []
+            self.last_motion_cnts = []
+            return False
+
+        self.score_stats["contours"] += 1
+        cnts = self.mask_contours(thresh, delta, img2)
 
-        cnts = self.compute_img_difference(grd_truth, img2)
+        self.last_motion_boxes = self.motion_boxes(cnts)
+        self.last_motion_cnts = cnts
 
-        return any(cv2.contourArea(elem) > self.min_area for elem in cnts)
+        return len(self.last_motion_boxes) > 0
 
-    def compute_img_difference(self, grd_truth, img2):
-        """Compute te difference between the ground image and the frame passed as img2
-        The ground image is supposed to be already preprocessed"""
+    def compute_img_difference(self, grd_truth, img2, learn=True):
+        """Compute te difference between the ground image and the grayscaled frame passed as img2
+        The ground image is supposed to be already preprocessed, the contours are in analysis coordinates.
+        If grd_truth is None the foreground is given by the background model, which learns from the frame if learn
+        is True"""
 
-        # blur and convert to grayscale
-        #gray = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
-        gray = cv2.blur(img2, self.blur, 0)
+        delta, thresh = self.compute_img_mask(grd_truth, img2, learn)
+
+        # return true to not loose any movement
+        if thresh is None:
+            return True
+
+        return self.mask_contours(thresh, delta, img2)
+
+    def compute_img_mask(self, grd_truth, img2, learn=True):
+        """Return the difference image and the thresholded one (None on errors) between the ground image and the
+        grayscaled frame img2, see compute_img_difference"""
+
+        # downscale and blur
+        gray = self.preprocess(img2)
 
-        # compute the absolute difference between the current frame and
-        # first frame
         try:
-            frameDelta = cv2.absdiff(grd_truth, gray)
+            if grd_truth is None:
+                # the background model gives the thresholded image directly
+                thresh_original = self.bk_model.apply(gray, learn)
+                frameDelta = thresh_original
+            else:
+                # compute the absolute difference between the current frame and
+                # first frame
+                frameDelta = cv2.absdiff(grd_truth, gray)
+                # get the thresholded image
+                thresh_original = cv2.threshold(frameDelta, self.min_bk_threshold, 255, cv2.THRESH_BINARY)[1]
         except cv2.error as e:
             # catch any error and log
-            error_log = "Cv Error: " + str(e) + "\ngrd_thruth : " + str(grd_truth.shape) + ", gray : " + str(
-                gray.shape) + "\n"
+            error_log = "Cv Error: " + str(e) + "\ngray : " + str(gray.shape) + "\n"
             logger.error(error_log)
             print(error_log)
-            # return true to not loose any movement
-            return True
+            return None, None
+
+        return frameDelta, thresh_original
 
-        # get the thresholded image
-        thresh_original = cv2.threshold(frameDelta, self.min_bk_threshold, 255, cv2.THRESH_BINARY)[1]
+    def mask_contours(self, thresh_original, frameDelta, img2):
+        """Dilate the thresholded image and return its contours"""
 
         # dilate the thresholded image to fill in holes, then find contours
         # on thresholded image
-        kernel= cv2.getStructuringElement(cv2.MORPH_RECT, self.dilate_window_size)
+        kernel= cv2.getStructuringElement(cv2.MORPH_RECT, self.scaled_size(self.dilate_window_size))
         thresh = cv2.dilate(thresh_original, kernel, iterations=1)
-        # get the contours of the changes
-        (_, cnts, _) = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        # get the contours of the changes, findContours modifies the image which is needed only for debugging
+        (_, cnts, _) = cv2.findContours(thresh.copy() if self.debug_flag else thresh, cv2.RETR_EXTERNAL,
+                                        cv2.CHAIN_APPROX_SIMPLE)
 
         # if the debug flag is true send all the images
         if self.debug_flag:
@@ -610,105 +1008,136 @@ class CamMovement(Thread):
         # return the contours
         return cnts
 
+    def quiet_bound(self):
+        """Return the minimum number of changed pixels that can give, once dilated, a contour bigger than min_area.
+        Every pixel grows at most to a dilate window, whose perimeter is 2*(w+h), and a contour with perimeter p
+        encloses at most (p/4)**2, holes included. So below 2*sqrt(min_area)/(w+h) pixels there cannot be movement"""
+
+        width, height = self.scaled_size(self.dilate_window_size)
+        return max(1, int(2 * self.scaled_min_area() ** 0.5 / (width + height)))
+
+    def analysis_scale(self):
+        """Return the ratio between the analysis resolution and the frame one"""
+        return self.analysis_resolution[0] / self.resolution[0]
+
+    def scaled_size(self, size):
+        """Scale a (width,height) window given for the full resolution to the analysis one"""
+        scale = self.analysis_scale()
+        return max(1, int(round(size[0] * scale))), max(1, int(round(size[1] * scale)))
+
+    def scaled_min_area(self):
+        """Return min_area in analysis coordinates"""
+        return self.min_area * self.analysis_scale() ** 2
+
+    def preprocess(self, gray):
+        """Downscale the grayscaled frame to the analysis resolution and blur it"""
+
+        if (gray.shape[1], gray.shape[0]) != self.analysis_resolution:
+            gray = cv2.resize(gray, self.analysis_resolution, interpolation=cv2.INTER_AREA)
+
+        return cv2.blur(gray, self.scaled_size(self.blur))
+
+    def motion_boxes(self, cnts):
+        """Return the bounding boxes (x,y,w,h), in frame coordinates, of the contours bigger than min_area"""
+
+        min_area = self.scaled_min_area()
+        scale = self.analysis_scale()
+
+        boxes = []
+        for c in cnts:
+            # if the contour is too small, ignore it
+            if cv2.contourArea(c) < min_area:
+                continue
+
+            (x, y, w, h) = cv2.boundingRect(c)
+            boxes.append((int(x / scale), int(y / scale), int(w / scale), int(h / scale)))
+
+        return boxes
+
     # =========================UTILS=======================================
     @time_profiler()
-    def draw_on_frames(self, frames, date=True):
-        """Function to draw on frames"""
-
-        face_color = (0, 0, 255)  # red
-        motion_color = (0, 255, 0)  # green
-        line_tickness = 2
+    def draw_on_frames(self, frames, video_name, date=True):
+        """Function to draw on the frames of a RecordingSession and write them in video_name"""
 
         # create the file
-        out = cv2.VideoWriter(self.video_name, 0x00000021, self.fps, self.resolution)
-        out.open(self.video_name, 0x00000021, self.fps, self.resolution)
+        out = cv2.VideoWriter(video_name, 0x00000021, self.fps, self.resolution)
+        out.open(video_name, 0x00000021, self.fps, self.resolution)
 
-        prov_cnts = 0
-        idx = 0
-        face_idx=0
-        to_write = "Unkown - Unkown"
         print("Total frames to save : "+str(len(frames)))
-        print("Total frames contours : "+str(len(self.faces_cnts)))
-        for frame in frames:
+        for idx, record in enumerate(frames):
+            # write frames on file
+            out.write(self.draw_frame(frames, idx, record, date))
 
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        # free file
+        out.release()
 
-            if self.face_photo_flag:
+    def draw_frame(self, frames, idx, record, date=True):
+        """Draw the faces, the movement and the date on the idx-th frame of a RecordingSession and return it"""
 
-                # take the corresponding contours for the frame
-                face = self.faces_cnts[face_idx]
-                face_idx+=1
+        face_color = (0, 0, 255)  # red
+        motion_color = (0, 255, 0)  # green
+        line_tickness = 2
 
-                # if there is a face
-                if face is not None:
-                    # get the corners of the faces
-                    for (x, y, w, h) in face:
-                        # draw a rectangle around the corners
-                        cv2.rectangle(frame, (x, y), (x + w, y + h), face_color, line_tickness)
+        # the session frames are shared with the other consumers, draw on a copy
+        frame = record.bgr.copy()
 
-            # draw movement
-            if self.green_squares:
-                cnts = self.compute_img_difference(self.ground_frame, gray)
+        if self.face_photo_flag:
 
-                # draw contours
-                for c in cnts:
-                    # if the contour is too small, ignore it
-                    # print("Area : "+str(cv2.contourArea(c)))
-                    if cv2.contourArea(c) < self.min_area:
-                        pass
+            # take the corresponding contours for the frame
+            face = frames.meta[idx].get("faces")
 
-                    else:
-                        # compute the bounding box for the contour, draw it on the frame,
-                        # and update the text
-                        (x, y, w, h) = cv2.boundingRect(c)
-                        cv2.rectangle(frame, (x, y), (x + w, y + h), motion_color, line_tickness)
-
-                # add black rectangle at the bottom
-                cv2.rectangle(frame, (0, frame.shape[0]), (frame.shape[1], frame.shape[0] - 30), (0, 0, 0), -1)
-
-                # write the movement direction
-                if not idx % 2:
-                    prov_cnts = cnts
-                elif len(prov_cnts) > 0 and len(cnts) > 0:
-                    movement, _ = self.movement_direction(prov_cnts, cnts)
-                    to_write = ""
-                    if movement[0]:
-                        to_write += "Incoming - "
+            # if there is a face
+            if face is not None:
+                # get the corners of the faces
+                for (x, y, w, h) in face:
+                    # draw a rectangle around the corners
+                    cv2.rectangle(frame, (x, y), (x + w, y + h), face_color, line_tickness)
 
-                    else:
-                        to_write += "Outgoing - "
+        # draw movement, found while recording
+        if self.green_squares:
+            motion = frames.motion_at(record.seq)
+            to_write = "Unkown - Unkown"
 
-                    if movement[1]:
-                        to_write += "Left"
+            if motion is not None:
+                # draw the bounding boxes of the moving objects with their direction
+                for track_id, (x, y, w, h), direction in motion["objects"]:
+                    cv2.rectangle(frame, (x, y), (x + w, y + h), motion_color, line_tickness)
+                    cv2.putText(frame, "#" + str(track_id) + " " + direction, (x, max(y - 5, 10)),
+                                cv2.FONT_HERSHEY_TRIPLEX, 0.4, motion_color, 1)
 
-                    else:
-                        to_write += "Right"
+                if motion["direction"] is not None:
+                    to_write = motion["direction"]
 
-                    # cv2.circle(frame, center_points[0], 1, (255, 255, 0), 10,2)
-                    # cv2.circle(frame, center_points[1], 1, (255, 255, 255), 10,2)
+            # add black rectangle at the bottom
+            cv2.rectangle(frame, (0, frame.shape[0]), (frame.shape[1], frame.shape[0] - 30), (0, 0, 0), -1)
 
-                cv2.putText(frame, to_write,
-                            (frame.shape[1] - 250, frame.shape[0] - 10), cv2.FONT_HERSHEY_TRIPLEX, 0.7, (0, 255, 255),
-                            1)
+            # write the movement direction
+            cv2.putText(frame, to_write,
+                        (frame.shape[1] - 250, frame.shape[0] - 10), cv2.FONT_HERSHEY_TRIPLEX, 0.7, (0, 255, 255),
+                        1)
 
-                idx += 1
+        # add a date to the frame
+        if date:
+            # write the capture time
+            correct_date = datetime.datetime.fromtimestamp(record.timestamp) + datetime.timedelta(hours=1)
 
-            # add a date to the frame
-            if date:
-                # write time
-                correct_date = datetime.datetime.now() + datetime.timedelta(hours=1)
+            cv2.putText(frame, correct_date.strftime("%A %d %B %Y %H:%M:%S"),
+                        (10, frame.shape[0] - 10), cv2.FONT_HERSHEY_TRIPLEX, 0.5, (0, 0, 255), 1)
 
-                cv2.putText(frame, correct_date.strftime("%A %d %B %Y %H:%M:%S"),
-                            (10, frame.shape[0] - 10), cv2.FONT_HERSHEY_TRIPLEX, 0.5, (0, 0, 255), 1)
+        return frame
 
-            # write frames on file
-            out.write(frame)
+    def overlays_ready(self, frames, idx, record):
+        """Check if the faces and the movement to draw on the idx-th frame of a recording are known"""
 
-        #empty the face contours list
-        self.faces_cnts=[]
+        # the scanner has not reached the frame yet
+        if self.face_photo_flag and "faces" not in frames.meta[idx] and self.face_scanner.is_pending(frames):
+            return False
 
-        # free file
-        out.release()
+        # the detector has not analyzed the frame yet
+        if self.green_squares and not frames.ended and not frames.has_motion_for(record.seq):
+            return False
+
+        return True
 
     def reset_ground(self, msg):
         """Reset the ground truth image"""
@@ -716,124 +1145,260 @@ class CamMovement(Thread):
         print("Reset ground image ...")
         # set the flag
         self.resetting_ground = True
+        self.ground_ready.clear()
 
-        # convert to gray and blur
-        gray = cv2.cvtColor(self.frame[-1], cv2.COLOR_BGR2GRAY)
-        gray = cv2.blur(gray, self.blur, 0)
+        # take the grayscaled frame, downscale and blur
+        gray = self.preprocess(self.latest_gray())
         # set the frame and notify
         self.ground_frame = gray
+        self.bk_model.reset(gray)
         self.telegram_handler.send_image(self.ground_frame, msg=msg)
 
         self.resetting_ground = False
+        self.ground_ready.set()
         print("Done")
 
-    @staticmethod
-    def movement_direction(cnts1, cnts2):
-        """Function to get the movement direction from two frames
-        returns a tuple where the first elem is the outgoing/incoming 0/1, the second is right/left 0/1"""
+    def set_background_model(self, name):
+        """Change the background model, the new one starts from the current frame"""
 
-        # the incoming outgoing movement is estimated throught the sum of the areas
-        # if sum(areas1)<sum(areas2) the object is outgoing
+        bk_model = make_background_model(name, self.min_bk_threshold)
+        bk_model.reset(self.preprocess(self.latest_gray()))
 
-        area1 = sum(cv2.contourArea(c) for c in cnts1)
-        area2 = sum(cv2.contourArea(c) for c in cnts2)
+        self.bk_model = bk_model
+        self.bk_model_type = name
+        logger.info("Background model set to " + name)
 
-        # print(area1,area2)
+    def next_frame(self):
+        """Wait for a frame never analyzed before and return its FrameRecord, with the grayscaled frame ready. Return
+        None if no frame arrives in frame_timeout seconds"""
 
-        # the left/right is given by the position of the averaged center of each area
-        # if center1>center2 the object is moving right to left (so left)
-        # get the centers of each area on the x axis
-        centers1 = []
-        centers2 = []
+        while True:
+            record = self.shotter.wait_for_frame(self.last_seq, self.frame_timeout)
+            if record is None:
+                return None
 
-        # get the area
-        for c in cnts1:
-            centers1.append(cv2.boundingRect(c))
+            self.last_seq = record.seq
+            # the frame has been overwritten in the ring before being grayscaled, take the next one
+            if record.gray is not None:
+                return record
 
-        # calculate the center point
-        center_point1 = [((x + (x + w)) / 2, (y + (y + h)) / 2) for (x, y, w, h) in centers1]
-        # calculate the mean position on the x axis
-        centers1 = [(x + (x + w)) / 2 for (x, y, w, h) in centers1]
+    def latest_gray(self):
+        """Return the grayscaled last frame of the ring, the new last one if it is overwritten before being
+        grayscaled"""
 
-        # get the area
-        for c in cnts2:
-            centers2.append(cv2.boundingRect(c))
+        gray = None
+        while gray is None:
+            gray = self.frame.latest().gray
 
-        center_point2 = [((x + (x + w)) / 2, (y + (y + h)) / 2) for (x, y, w, h) in centers2]
-        # calculate the mean position on the x axis
-        centers2 = [(x + (x + w)) / 2 for (x, y, w, h) in centers2]
+        return gray
 
-        # avarage the center
-        centers1 = sum(centers1) / len(centers1)
-        centers2 = sum(centers2) / len(centers2)
+    @staticmethod
+    def direction_text(movement):
+        """Return the text for the (incoming, left) movement of a MotionTrack"""
 
-        # avarage the center
-        center_point1 = (int(sum(elem[0] for elem in center_point1) / len(center_point1)),
-                         int(sum(elem[1] for elem in center_point1) / len(center_point1)))
-        center_point2 = (int(sum(elem[0] for elem in center_point2) / len(center_point2)),
-                         int(sum(elem[1] for elem in center_point2) / len(center_point2)))
+        to_write = ""
+        if movement[0]:
+            to_write += "Incoming - "
 
-        # print(center_point1,center_point2)
+        else:
+            to_write += "Outgoing - "
 
-        return (area1 < area2, centers1 > centers2), (center_point1, center_point2)
+        if movement[1]:
+            to_write += "Left"
+
+        else:
+            to_write += "Right"
+
+        return to_write
 
     # =========================FACE DETECION=======================================
 
     #@time_profiler()
     def face_from_video(self, frames):
-        """Detect faces from list of frames"""
+        """Collect the faces from the frames of a RecordingSession. The frames are scanned by the FaceScanner while
+        recording, so only the frames it did not reach are scanned here"""
 
         print("Starting face detection...")
 
-        crop_frames = []
-        faces = 0
+        # wait for the scanner to be done with the session
+        self.face_scanner.wait(frames)
 
-        # for every frame in the video
-        for frame in frames:
+        # scan the frames missed by the scanner
+        missed = [idx for idx in range(len(frames)) if "faces" not in frames.meta[idx]]
+        for future in [self.face_pool.submit(self.scan_frame, frames, idx) for idx in missed]:
+            future.result()
+
+        faces = 0
+        crops = []
+        tracks = []
+        # follow the faces across the frames, so that the best crops of every person can be chosen
+        face_tracker = MotionTracker(min_iou=0.3, max_distance=2 * self.face_size, max_missed=self.fps)
 
-            # detect if there is a face
-            face = self.detect_face(frame)
-            self.faces_cnts.append(face)
+        # for every frame in the video, a frame not scanned has no faces
+        for idx, meta in enumerate(frames.meta):
 
             # if there is a face
-            if face is not None:
+            if meta.get("faces") is not None:
                 faces += 1
-                # get the corners of the faces
-                # if user want the face video too crop the image where face is detected
-                if self.face_photo_flag:
-                    for (x, y, w, h) in face:
-                        blur_var=cv2.Laplacian(frame[y:y + h, x:x + w], cv2.CV_64F).var()
-                        #print(blur_var)
-                        #if the blur index of the image is grather than the threshold
-                        if blur_var>=self.max_blurrines:
-                            crop_frames.append(frame[y:y + h, x:x + w])
-                            #self.telegram_handler.send_image(frame[y:y + h, x:x + w],msg="Blurr ok : "+str(blur_var))
 
-                        else:
-                            #self.telegram_handler.send_image(frame[y:y + h, x:x + w],msg="Too blurry : "+str(blur_var))
-                            pass
+            crops.extend(meta.get("crops", []))
+            tracks.extend(face_tracker.update(idx, idx / self.fps, meta.get("crop_boxes", [])))
+
+        # how many times the cascade had to run
+        detections = sum(1 for meta in frames.meta if meta.get("detected"))
+        self.last_face_scan = str(faces) + " frames with faces, " + str(detections) + " detector calls over " + str(
+            len(frames)) + " frames"
+        logger.info("Event " + str(frames.event_id) + " : " + self.last_face_scan)
 
         print(str(faces) + " frames with faces detected")
         print("... face detector end")
 
+        crop_frames = self.best_crops(crops, tracks)
+        logger.info("Event " + str(frames.event_id) + " : " + str(len(crop_frames)) + " face crops selected of " + str(
+            len(crops)) + " from " + str(len(set(tracks))) + " faces")
+
         # if there are some images with faces only
         if len(crop_frames) > 0:
 
-            # if the users want to recognize faces
-            if self.face_reco_falg:
-                # try to move te images to the Unknown folder
-                if not self.face_recognizer.add_image_write(crop_frames):
-                    print("Error during the insertion of face images into dir")
-                    logger.error("Error during the insertion of face images into dir")
+            # predict the crops, in one batch with the numpy engine otherwise on the face workers
+            predictions = self.face_recognizer.predict_batch(crop_frames, self.face_pool)
 
-            # get the final face image denoising the others
-            faces_img=self.face_recognizer.predict_multi(crop_frames)
+            # get the final face image denoising the others, the crops not recognized surely are written in the
+            # Unknown folder to be classified
+            faces_img=self.face_recognizer.predict_multi(crop_frames, predictions)
 
         else:
             faces_img = []
 
         return faces_img
 
+    def best_crops(self, crops, tracks):
+        """Return the top_faces crops with the best quality of every face, tracks is the face of every crop"""
+
+        scores = self.face_quality.score(crops)
+
+        best = {}
+        for crop, track, score in zip(crops, tracks, scores):
+            best.setdefault(track.track_id, []).append((score, crop))
+
+        selected = []
+        for track_id in sorted(best):
+            ranked = sorted(best[track_id], key=lambda elem: elem[0], reverse=True)
+            selected.extend(crop for _, crop in ranked[:self.top_faces])
+
+        return selected
+
+    def scan_frame(self, frames, idx, tracker=None):
+        """Detect the faces in the idx-th frame of a RecordingSession. The faces and the crops sharp enough to be
+        recognized, with their boxes, are saved in the frame meta.
+        When a FaceTracker is given (frames must be scanned in order) the cascade runs one frame every
+        face_detect_every, or when a face is lost, and the faces are tracked in the others"""
+
+        record = frames.frame(idx)
+        frame = record.bgr
+
+        full_scan = idx % self.full_scan_every == 0
+        detect = tracker is None or full_scan or idx % self.face_detect_every == 0 or tracker.lost
+
+        if not detect:
+            # follow the faces found by the last detection
+            face = tracker.update(record.gray)
+            detect = tracker.lost
+
+        if detect:
+            # detect if there is a face on the grayscaled frame, where the movement is
+            motion = frames.motion_at(record.seq)
+            boxes = None if motion is None else motion["boxes"]
+            face = self.detect_face_in_motion(record.gray, boxes, full_scan)
+            if tracker is not None:
+                tracker.start(record.gray, face)
+
+        crops = []
+        crop_boxes = []
+        if face is not None:
+            # crop the image where face is detected
+            for (x, y, w, h) in face:
+                blur_var = cv2.Laplacian(frame[y:y + h, x:x + w], cv2.CV_64F).var()
+                # if the blur index of the image is grather than the threshold
+                if blur_var >= self.max_blurrines:
+                    crops.append(frame[y:y + h, x:x + w])
+                    crop_boxes.append((x, y, w, h))
+
+        meta = frames.meta[idx]
+        meta["detected"] = detect
+        meta["crops"] = crops
+        meta["crop_boxes"] = crop_boxes
+        # faces is set last, since it marks the frame as scanned
+        meta["faces"] = face
+        frames.notify()
+
+    def face_cascade(self):
+        """Return the frontal face cascade of the calling thread"""
+
+        if threading.current_thread() is self:
+            return self.frontal_face_cascade
+
+        if not hasattr(self.thread_cascades, "frontal"):
+            self.thread_cascades.frontal = cv2.CascadeClassifier(self.frontal_face_path)
+
+        return self.thread_cascades.frontal
+
+    def detect_face_in_motion(self, gray, boxes, full_scan=False):
+        """Detect faces only in the regions around the motion boxes, the faces are returned in frame coordinates.
+        The whole frame is searched when full_scan is True or the boxes are unknown (None)"""
+
+        if full_scan or boxes is None:
+            self.face_stats["full"] += 1
+            return self.detect_face(gray)
+
+        regions = self.face_regions(boxes, gray.shape)
+        if not regions:
+            self.face_stats["skipped"] += 1
+            return None
+
+        self.face_stats["roi"] += 1
+
+        faces = []
+        for (x1, y1, x2, y2) in regions:
+            found = self.detect_face(gray[y1:y2, x1:x2])
+            if found is not None:
+                # back to frame coordinates
+                faces.extend((x + x1, y + y1, w, h) for (x, y, w, h) in found)
+
+        if len(faces) > 0:
+            return np.array(faces)
+
+        return None
+
+    def face_regions(self, boxes, shape):
+        """Pad the motion boxes (x,y,w,h) by face_roi_padding, merge the overlapping ones and clip them to the frame
+        shape. Return the regions as (x1,y1,x2,y2), the ones smaller than a face are discarded"""
+
+        height, width = shape[:2]
+
+        regions = []
+        for (x, y, w, h) in boxes:
+            pad_w = max(int(w * self.face_roi_padding), self.face_size)
+            pad_h = max(int(h * self.face_roi_padding), self.face_size)
+            regions.append((max(0, x - pad_w), max(0, y - pad_h), min(width, x + w + pad_w), min(height, y + h + pad_h)))
+
+        # merge the overlapping regions until there are none, so that no pixel is searched twice
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(regions)):
+                for j in range(i + 1, len(regions)):
+                    a, b = regions[i], regions[j]
+                    if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                        regions[i] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                        del regions[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+
+        return [r for r in regions if r[2] - r[0] >= self.face_size and r[3] - r[1] >= self.face_size]
+
     def detect_face(self, img,scale_factor=1.4,min_neight=3):
         """Detect faces using the cascades"""
         # setting the parameters
@@ -843,7 +1408,7 @@ class CamMovement(Thread):
         # converting to gray
         #img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
         # try to detect the front face
-        faces = self.frontal_face_cascade.detectMultiScale(img, scaleFactor=scale_factor, minNeighbors=min_neight,minSize=min_size)
+        faces = self.face_cascade().detectMultiScale(img, scaleFactor=scale_factor, minNeighbors=min_neight,minSize=min_size)
         if len(faces) > 0:
             # print("face detcted!")
             return faces
@@ -875,14 +1440,14 @@ class CamMovement(Thread):
 
     def send_ground(self, specific_id, msg):
         """Send the ground image to the users"""
-        self.telegram_handler.send_image(self.ground_frame, specific_id=specific_id, msg=msg)
+        self.telegram_handler.send_image(self.bk_model.background(), specific_id=specific_id, msg=msg)
 
     # =========================DEPRECATED=======================================
 
     def detect_motion_photo(self):
-        initial_frame = self.frame[-1]
+        initial_frame = self.frame.copy().gray
         sleep(self.delay)
-        end_frame = self.frame[-1]
+        end_frame = self.frame.copy().gray
 
         # calculate diversity
         score = self.are_different(initial_frame, end_frame)
@@ -893,7 +1458,7 @@ class CamMovement(Thread):
             self.motion_notifier(score)
 
             # take a new (more recent) frame
-            prov = self.frame[-1]
+            prov = self.frame.latest().gray
 
             # take the time
             start = datetime.datetime.now()
@@ -915,7 +1480,7 @@ class CamMovement(Thread):
                     break
 
                 # take another frame
-                prov = self.frame[-1]
+                prov = self.frame.latest().gray
 
                 # if time is exceeded exit while
                 if (end - start).seconds > self.max_seconds_retries:
@@ -974,6 +1539,74 @@ class CamMovement(Thread):
         return denoised
 
 
+class FaceScanner(SessionWorker):
+    """Thread detecting the faces in the frames of a RecordingSession while it is still being recorded, so that when
+    the movement ends the faces and their crops are ready. The sessions are scanned in the order they are
+    given, a frame at a time as soon as the shotter stores it
+
+    Attributes:
+        motion : the CamMovement the scanner works for, its scan_frame is called on every frame
+
+    """
+
+    def __init__(self, motion):
+        SessionWorker.__init__(self, "FaceScanner")
+
+        self.motion = motion
+
+    def scan(self, session):
+        """Queue a session to be scanned"""
+        self.submit(session)
+
+    def process(self, session):
+        """Scan the frames of a session as they are stored, until the recording ends"""
+
+        # the frames come in order, so the faces can be tracked between the detections
+        tracker = FaceTracker() if self.motion.face_detect_every > 1 else None
+
+        # without tracking the frames are independent and are handed to the face workers
+        futures = []
+
+        idx = 0
+        while not self.stopped():
+            if session.wait_for_index(idx, timeout=1):
+                if tracker is None:
+                    futures.append(self.motion.face_pool.submit(self.motion.scan_frame, session, idx))
+                else:
+                    self.motion.scan_frame(session, idx, tracker)
+                idx += 1
+            elif session.ended:
+                break
+
+        # the results are in the frames meta, wait for all of them and raise the workers errors
+        for future in futures:
+            future.result()
+
+        logger.debug("Scanned " + str(idx) + " frames of event " + str(session.event_id))
+
+
+class ContactSheetSender(SessionWorker):
+    """Thread sending the contact sheet of a RecordingSession as soon as the recording ends, apart from the
+    EventPipeline, so that it is neither late behind the events being processed nor lost with a dropped event
+
+    Attributes:
+        motion : the CamMovement the sender works for, its send_contact_sheet is called on every session
+
+    """
+
+    def __init__(self, motion):
+        SessionWorker.__init__(self, "ContactSheetSender")
+
+        self.motion = motion
+
+    def send(self, session):
+        """Queue a session to send its contact sheet"""
+        self.submit(session)
+
+    def process(self, session):
+        self.motion.send_contact_sheet(session)
+
+
 class TelegramHandler(Thread):
     """Class to handle image/message/video sending throught telegram bot"""
 
@@ -1012,40 +1645,25 @@ class TelegramHandler(Thread):
             # return the default id
             return [fallback_id]
 
-    def send_image(self, img, specific_id=0, msg=""):
-        """Send an image to the ids """
-
-        image_name = "image_to_send.png"
+    def send_image(self, img, specific_id=0, msg="", image_name="image_to_send.png", params=()):
+        """Send an image to the ids, image_name is the name of the file sent (its extension sets the format) and params
+        the cv2.imencode parameters. The image is encoded in memory, so more threads can send images at once"""
 
-        ret = cv2.imwrite(image_name, img)
+        ret, data = cv2.imencode(os.path.splitext(image_name)[1], img, params)
 
-        if not ret and specific_id:
+        if not ret:
             self.send_message("There has been an error while writing the image", specific_id=specific_id)
             return
-        elif not ret:
-            if not ret and specific_id:
-                self.send_message("There has been an error while writing the image")
-                return
-
-        else:
-            with open(image_name, "rb") as file:
-                if not specific_id:
-                    for user_id in self.ids:
-                        if msg:
-                            self.bot.sendPhoto(user_id, file, caption=msg)
-                        else:
-                            self.bot.sendPhoto(user_id, file)
-                else:
-                    if msg:
-                        self.bot.sendPhoto(specific_id, file, caption=msg)
-                    else:
-                        self.bot.sendPhoto(specific_id, file)
-
-        try:
-            os.remove(image_name)
-        except FileNotFoundError:
-            pass
 
+        ids = [specific_id] if specific_id else self.ids
+        for user_id in ids:
+            # every send reads the file till the end
+            file = io.BytesIO(data.tobytes())
+            file.name = image_name
+            if msg:
+                self.bot.sendPhoto(user_id, file, caption=msg)
+            else:
+                self.bot.sendPhoto(user_id, file)
 
         logger.info("Image sent")
 
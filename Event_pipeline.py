@@ -0,0 +1,238 @@
+import logging
+import queue
+import sys
+import threading
+import traceback
+from threading import Thread
+from time import time
+
+logger = logging.getLogger('motionlog')
+
+
+class EventPipeline:
+    """Bounded pool of worker threads post-processing the motion events (face analysis, drawing, encoding and
+    sending), so that the motion detection can go on while an event is being processed.
+    The events waiting are bounded by the memory their frames hold: with a MemoryBudget submit waits until min_free
+    bytes are free for the next recordings, and max_events is only a cap on their number. When there is no room within
+    submit_timeout seconds the event is dropped
+
+    Attributes:
+        handler : the function called with every event
+        events : the bounded queue of events waiting for a worker
+        max_events : the size of the queue
+        budget : the MemoryBudget shared with the RecordingSession, None to bound the events by number only
+        min_free : the bytes of the budget that must be free to take a new event
+        submit_timeout : the seconds submit waits for a free place
+        workers : the EventWorker threads
+        submitted : the number of events submitted
+        processed : the number of events processed
+        dropped : the number of events dropped because the queue or the budget was full
+        max_depth : the maximum number of events seen waiting in the queue
+        lock : lock for the counters
+
+    """
+
+    def __init__(self, handler, workers=2, max_events=16, submit_timeout=5, budget=None, min_free=64 * 2 ** 20):
+
+        self.handler = handler
+        self.max_events = max_events
+        self.budget = budget
+        self.min_free = min_free
+        self.submit_timeout = submit_timeout
+        self.events = queue.Queue(maxsize=max_events)
+
+        self.submitted = 0
+        self.processed = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.lock = threading.Lock()
+
+        self.workers = [EventWorker(self, idx) for idx in range(workers)]
+
+    def start(self):
+        """Start the workers"""
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        """Stop the workers, the events still in the queue are not processed"""
+
+        for worker in self.workers:
+            worker.stop()
+
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.join()
+
+    def submit(self, event):
+        """Queue an event, return False if it has been dropped because the queue or the budget stayed full"""
+
+        start = time()
+        if self.budget is not None and not self.budget.wait_for_room(self.min_free, self.submit_timeout):
+            with self.lock:
+                self.dropped += 1
+            logger.warning("Event memory budget full (" + self.budget.stats() + "), event dropped")
+            return False
+
+        try:
+            self.events.put(event, timeout=max(0, self.submit_timeout - (time() - start)))
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            logger.warning("Event queue full, event dropped")
+            return False
+
+        with self.lock:
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, self.events.qsize())
+
+        return True
+
+    def depth(self):
+        """Return the number of events waiting for a worker"""
+        return self.events.qsize()
+
+    def process(self, event):
+        """Call the handler on the event, logging any exception"""
+
+        try:
+            self.handler(event)
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
+            logger.error(''.join('!! ' + line for line in lines))
+
+        with self.lock:
+            self.processed += 1
+
+    def stats(self):
+        """Return a string with the pipeline metrics"""
+
+        return "depth " + str(self.depth()) + "/" + str(self.max_events) + " (max " + str(
+            self.max_depth) + "), processed " + str(self.processed) + "/" + str(
+            self.submitted) + ", dropped " + str(self.dropped) + (
+            ", memory " + self.budget.stats() if self.budget is not None else "")
+
+
+class EventWorker(Thread):
+    """Thread taking the events from the pipeline queue
+
+    Attributes:
+        pipeline : the EventPipeline the worker belongs to
+        stop_event : the event to handle thread stopping
+
+    """
+
+    def __init__(self, pipeline, idx):
+        Thread.__init__(self, name="EventWorker-" + str(idx))
+
+        self.pipeline = pipeline
+        self.stop_event = threading.Event()
+
+    def run(self):
+
+        while not self.stopped():
+            try:
+                event = self.pipeline.events.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            self.pipeline.process(event)
+            self.pipeline.events.task_done()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def stopped(self):
+        return self.stop_event.is_set()
+
+
+class SessionWorker(Thread):
+    """Thread processing the RecordingSession handed to it one at a time, in the order they are given, usually while
+    they are still being recorded. Who frees a session waits for the worker to be done with it.
+    Subclasses implement process(session, *args), what it returns is given back by wait
+
+    Attributes:
+        jobs : the queue of the (session, args) to process
+        done : the events set once a session has been processed, by session event_id
+        results : what process returned (None when it failed), by session event_id
+        lock : lock for done and results
+        stop_event : the event to handle thread stopping
+
+    """
+
+    def __init__(self, name):
+        Thread.__init__(self, name=name)
+
+        self.jobs = queue.Queue()
+        self.done = {}
+        self.results = {}
+
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    def submit(self, session, *args):
+        """Queue a session to be processed with args"""
+
+        with self.lock:
+            self.done[session.event_id] = threading.Event()
+        self.jobs.put((session, args))
+
+    def is_pending(self, session):
+        """Check if the session is queued or being processed"""
+
+        with self.lock:
+            done = self.done.get(session.event_id)
+
+        return done is not None and not done.is_set()
+
+    def wait(self, session):
+        """Block until the session has been processed and return what process returned, None at once if the session
+        was never queued"""
+
+        with self.lock:
+            done = self.done.get(session.event_id)
+
+        if done is None:
+            return None
+
+        # the worker may be stopped with the session still in the queue
+        while not done.wait(1):
+            if self.stopped():
+                break
+
+        with self.lock:
+            self.done.pop(session.event_id, None)
+            return self.results.pop(session.event_id, None)
+
+    def run(self):
+
+        while not self.stopped():
+            try:
+                session, args = self.jobs.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            result = None
+            try:
+                result = self.process(session, *args)
+            except:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
+                logger.error(''.join('!! ' + line for line in lines))
+            finally:
+                with self.lock:
+                    self.results[session.event_id] = result
+                    done = self.done.get(session.event_id)
+                if done is not None:
+                    done.set()
+
+    def process(self, session, *args):
+        """Process a session, implemented by the subclasses"""
+        raise NotImplementedError
+
+    def stop(self):
+        self.stop_event.set()
+
+    def stopped(self):
+        return self.stop_event.is_set()
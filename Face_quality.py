@@ -0,0 +1,74 @@
+import cv2
+import numpy as np
+
+
+class FaceQuality:
+    """Score how good the face crops are for the recognition, all the crops of an event at once.
+    The crops are grayscaled and downscaled to size x size, stacked, and every component is computed with numpy on the
+    whole stack:
+        sharpness : the variance of the laplacian, normalized by sharpness_scale
+        size : the crop width relative to good_size, bigger faces hold more details
+        frontalness : the correlation between the crop and its mirror image, faces looking at the camera are symmetric
+        exposure : how far the mean intensity is from the under/over exposed extremes
+    The score is the weighted mean of the components, every one in (0,1)
+
+    Attributes:
+        size : the side of the downscaled crops
+        good_size : the crop width, in pixels, from which the size component is 1
+        sharpness_scale : the laplacian variance, on the downscaled crops, from which the sharpness component is 1
+        weights : the weight of every component, as a dictionary
+
+    """
+
+    def __init__(self, size=48, good_size=120, sharpness_scale=400):
+        self.size = size
+        self.good_size = good_size
+        self.sharpness_scale = sharpness_scale
+        self.weights = {"sharpness": 0.4, "size": 0.2, "frontalness": 0.25, "exposure": 0.15}
+
+    def stack(self, crops):
+        """Return the crops grayscaled and downscaled as a (crops,size,size) float array"""
+
+        stack = np.empty((len(crops), self.size, self.size), dtype=np.float32)
+        for idx, crop in enumerate(crops):
+            if crop.ndim == 3:
+                crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+            stack[idx] = cv2.resize(crop, (self.size, self.size), interpolation=cv2.INTER_AREA)
+
+        return stack
+
+    def components(self, crops):
+        """Return a dictionary with the array of every component for the crops"""
+
+        stack = self.stack(crops)
+        widths = np.array([crop.shape[1] for crop in crops], dtype=np.float32)
+
+        # 4 neighbours laplacian on the inner pixels of every crop
+        laplacian = (stack[:, :-2, 1:-1] + stack[:, 2:, 1:-1] + stack[:, 1:-1, :-2] + stack[:, 1:-1, 2:] -
+                     4 * stack[:, 1:-1, 1:-1])
+        sharpness = np.minimum(laplacian.reshape(len(crops), -1).var(axis=1) / self.sharpness_scale, 1)
+
+        size = np.minimum(widths / self.good_size, 1)
+
+        # correlation between the crops and their mirror images
+        flat = stack.reshape(len(crops), -1)
+        mirror = stack[:, :, ::-1].reshape(len(crops), -1)
+        flat = flat - flat.mean(axis=1, keepdims=True)
+        mirror = mirror - mirror.mean(axis=1, keepdims=True)
+        norms = np.sqrt((flat ** 2).sum(axis=1) * (mirror ** 2).sum(axis=1))
+        frontalness = np.clip((flat * mirror).sum(axis=1) / np.maximum(norms, 1e-6), 0, 1)
+
+        exposure = 1 - np.abs(stack.mean(axis=(1, 2)) - 128) / 128
+
+        return {"sharpness": sharpness, "size": size, "frontalness": frontalness, "exposure": exposure}
+
+    def score(self, crops):
+        """Return the array of the scores of the crops"""
+
+        if len(crops) == 0:
+            return np.zeros(0, dtype=np.float32)
+
+        components = self.components(crops)
+        total = sum(self.weights.values())
+
+        return sum(weight * components[name] for name, weight in self.weights.items()) / total
@@ -2,6 +2,7 @@ import glob
 import random
 import threading
 from threading import Thread
+from time import strftime, time
 import cv2
 import numpy as np
 import os
@@ -14,6 +15,10 @@ from telegram.ext import ConversationHandler, CommandHandler, MessageHandler, Ca
 
 from cv2.face import *
 
+from Face_registry import SubjectRegistry
+from Lbph_engine import LbphEngine
+from Model_store import ModelStore
+
 
 class FaceRecognizer(Thread):
     """Class dedicated to face recognition
@@ -24,9 +29,24 @@ class FaceRecognizer(Thread):
         faces_dir : the directory Faces
         unknown : the Unknown direcotry
         recognizer_path : the path to the recognizer object
+        engine_path : the path to the binary model of the numpy engine, migrated from recognizer_path the first time
+        migration_path : the file marking a migration failed, to be tried again at the next start
+        registry : the SubjectRegistry with the label, name and directory of every subject
+        unknown_lock : lock for the names of the images written in the Unknown directory
         stop_event : The event to handle thread stopping
 
-        recognizer: the classifier used for face rocognition
+        train_event : the event set when a training is requested
+        train_delay : the seconds without new requests to wait before training, so that a burst of classifications is
+            trained on at once
+        train_requested : the time of the last training request
+        train_requests : the number of requests since the last training
+        train_stats : the progress of the training, or the metrics of the last one
+        train_lock : lock for the training requests
+
+        recognizer_type : the recognizer used, opencv (cv2.face LBPH, one face per call) or numpy (LbphEngine, batches)
+        recognizer: the classifier used for face rocognition when recognizer_type is opencv
+        engine : the LbphEngine used when recognizer_type is numpy
+        store : the ModelStore with the samples of the engine
         image_size : the image size for the training and prediction
         distance_thres : the maximum distance accepted for recognition confidence
         auto_train_dist : the maximum distance accepted for auto recognition and training
@@ -46,11 +66,27 @@ class FaceRecognizer(Thread):
         self.faces_dir = "Faces/"
         self.unknown = self.faces_dir + "Unknown/"
         self.recognizer_path = "Resources/recognizer.yaml"
+        self.engine_path = "Resources/recognizer.lbph"
+        self.migration_path = self.engine_path + ".migrate"
+        self.registry = SubjectRegistry(self.faces_dir)
+        self.unknown_lock = threading.Lock()
         self.stop_event = threading.Event()
 
+        # ======TRAINING VARIABLES======
+        self.train_event = threading.Event()
+        self.train_delay = 2
+        self.train_requested = 0
+        self.train_requests = 0
+        self.train_stats = "not trained yet"
+        self.train_lock = threading.Lock()
+
         # ======RECOGNIZER VARIABLES======
-        self.recognizer = self.load_recognizer()
         self.image_size = (200, 200)
+        self.recognizer_type = "numpy"
+        self.recognizer = None
+        self.engine = None
+        self.store = None
+        self.load_model()
         self.distance_thres = 95
         self.auto_train_dist = 80
 
@@ -85,17 +121,42 @@ class FaceRecognizer(Thread):
         disp.add_handler(CallbackQueryHandler(self.end_callback, pattern="/end"))
 
     def run(self):
-        """Run the thread, first train the model then just be alive"""
+        """Run the thread, train the model at startup and every time it is requested, while the predictions go on
+        with the previous model"""
 
-        self.train_model()
+        self.request_training()
         # updater.start_polling()
 
-        while True:
-            # if the thread has been stopped
-            if self.stopped():
-                # save the recognizer
-                self.recognizer.save(self.recognizer_path)
-                return
+        while not self.stopped():
+            if not self.train_event.wait(1):
+                continue
+
+            # wait for the requests to stop coming
+            if time() - self.train_requested < self.train_delay:
+                self.stop_event.wait(self.train_delay - (time() - self.train_requested))
+                continue
+
+            with self.train_lock:
+                self.train_event.clear()
+                requests = self.train_requests
+                self.train_requests = 0
+
+            try:
+                self.train_model(requests)
+            except Exception as e:
+                print("Training failed : " + str(e))
+                self.train_stats = "failed : " + str(e)
+
+        # save the recognizer
+        self.save_model()
+
+    def request_training(self):
+        """Ask the thread to train the model on the new images"""
+
+        with self.train_lock:
+            self.train_requested = time()
+            self.train_requests += 1
+            self.train_event.set()
 
     def stop(self):
         self.stop_event.set()
@@ -155,15 +216,13 @@ class FaceRecognizer(Thread):
         user_id = update._effective_user.id
 
         # check if the name is in the faces dir
-        dir_name = [elem for elem in os.listdir(self.faces_dir) if s_name in elem]
-        if len(dir_name) == 0:
+        dir_name = self.registry.directory(s_name)
+        if not dir_name:
             self.back_to_start(bot, update, "Sorry no face found with name " + s_name)
             return
 
-        # take the dir name
-        dir_name = dir_name[0] + "/"
         # for every image in the dir
-        for image in glob.glob(self.faces_dir + dir_name + '*.png'):
+        for image in glob.glob(dir_name + '*.png'):
             # open the image and send it
             with open(image, "rb") as file:
                 bot.sendPhoto(user_id, file)
@@ -215,18 +274,13 @@ class FaceRecognizer(Thread):
         image_name = param[1]
         dir_name = param[2]
 
-        # get the length of the images in the directory
-        dir_name = self.faces_dir + self.get_name_dir(dir_name) + "/"
-        idx = len([name for name in os.listdir(dir_name)])
-        # generate new image name
-        new_image_name = dir_name + "image_" + str(idx) + ".png"
-
         # delete the photo message
         self.end_callback(bot, update, calling=False)
 
         # move the image
         try:
-            os.rename(image_name, new_image_name)
+            if not self.registry.add_image(dir_name, image_name):
+                update.callback_query.message.reply_text("Person " + dir_name + " not found, photo not moved")
         except FileNotFoundError:
             update.callback_query.message.reply_text("Photo not found")
 
@@ -284,7 +338,7 @@ class FaceRecognizer(Thread):
             update.message.reply_text("I told you to be carefull!")
             return ConversationHandler.END
 
-        if glob.glob(self.faces_dir + "*_" + face_name):
+        if self.registry.label(face_name) is not None:
             update.message.reply_text("You cannot use the same name for two faces")
             return ConversationHandler.END
 
@@ -326,30 +380,41 @@ class FaceRecognizer(Thread):
 
         )
 
-        # look for new images in the Unknown direcotory and delete recognized ones
-        if calling: self.train_model()
+        # train on the new images in background
+        if calling: self.request_training()
 
     # ===================RECOGNIZER=========================
 
-    def train_model(self):
-        """Function to train the recognizer"""
+    def train_model(self, requests=1):
+        """Function to train the recognizer, the new model replaces the old one only once it is complete
+        :param requests: the number of training requests served
+        """
 
         print("Training model...")
+        start = time()
 
         # prepare the data
+        self.train_stats = "reading the new images"
         faces, labels = self.prepare_training_data()
+        read = time() - start
 
         print("Training on " + str(len(faces)) + " faces")
 
         if len(faces) == 0 or len(labels) == 0:
             print("No data to train with")
+            self.train_stats = "no new images at " + strftime("%H:%M:%S") + " (" + str(requests) + " requests)"
             return
+
         # train
-        self.recognizer.update(faces, np.array(labels))
+        self.train_stats = "training on " + str(len(faces)) + " faces"
+        if self.recognizer_type == "numpy":
+            self.update_engine(faces, labels)
+        else:
+            self.update_recognizer(faces, labels)
         # self.recognizer.train(faces, np.array(labels))
 
-        # saving the recognizer object
-        self.recognizer.save(self.recognizer_path)
+        self.train_stats = str(len(faces)) + " faces at " + strftime("%H:%M:%S") + " in " + str(
+            round(time() - start, 2)) + " s (reading " + str(round(read, 2)) + " s), " + str(requests) + " requests"
 
         print("....Model trained and saved")
 
@@ -367,6 +432,9 @@ class FaceRecognizer(Thread):
             print("No image for prediction")
             return -1, sys.maxsize
 
+        if self.recognizer_type == "numpy":
+            return self.predict_batch([img])[0]
+
         # resize, convert to right unit type and turn image to grayscale
         if (img.shape[0], img.shape[1]) != self.image_size:
             img = cv2.resize(img, self.image_size)
@@ -377,9 +445,10 @@ class FaceRecognizer(Thread):
 
         # create the collector to get the label and the confidence
         collector = MinDistancePredictCollector()
-        # predict face
+        # predict face, the training thread may replace the recognizer meanwhile
+        recognizer = self.recognizer
         try:
-            self.recognizer.predict(gray, collector, 0)
+            recognizer.predict(gray, collector, 0)
         except cv2.error:
             # the prediction may not work when the model has not been trained before
             return -1, sys.maxsize
@@ -396,9 +465,38 @@ class FaceRecognizer(Thread):
         # print("...Prediction end")
         return label_text, confidence
 
-    def predict_multi(self, imgs):
+    def predict_batch(self, imgs, pool=None):
+        """
+        Predict the person face in every image, with one call to the engine when recognizer_type is numpy
+        :param imgs: list of opencv images
+        :param pool: optional executor to run the opencv predictions on
+        :return: list of (label_text, confidence) in the same order of imgs
+        """
+
+        if self.recognizer_type != "numpy":
+            if pool is not None:
+                return list(pool.map(self.predict, imgs))
+            return [self.predict(img) for img in imgs]
+
+        predictions = [(-1, sys.maxsize)] * len(imgs)
+        valid = [idx for idx, img in enumerate(imgs) if len(img) > 0]
+        if not valid:
+            return predictions
+
+        labels, distances = self.engine.predict([imgs[idx] for idx in valid])
+
+        for idx, label, distance in zip(valid, labels, distances):
+            # the model has not been trained yet
+            if not np.isfinite(distance):
+                continue
+            predictions[idx] = (self.name_from_label(int(label)), float(distance))
+
+        return predictions
+
+    def predict_multi(self, imgs, predictions=None):
         """ Predict faces in multiple images
         :param imgs: list of images
+        :param predictions: optional list of (face_name, confidence) already computed for imgs, in the same order
         :return: list of triples (face_name, confidence,image) for every Different face in the image list
         """
 
@@ -410,9 +508,12 @@ class FaceRecognizer(Thread):
         to_filter = []
         to_add = []  # list to store iamges to add to Unknown folder
 
-        for img in imgs:
-            # get the name and the confidence
-            face_name, confidence = self.predict(img)
+        # get the names and the confidences, unless they are known already
+        if predictions is None:
+            predictions = self.predict_batch(imgs)
+
+        for idx, img in enumerate(imgs):
+            face_name, confidence = predictions[idx]
             # append infos if confidence is less than threshold
             if confidence <= self.distance_thres:
                 to_filter.append((face_name, confidence, img))
@@ -441,12 +542,12 @@ class FaceRecognizer(Thread):
         # get all the images in the unknown direcotry
         images = glob.glob(self.unknown + "*.png")
 
+        # predict names
+        predictions = self.predict_batch([cv2.imread(image_path) for image_path in images])
+
         idx = 0
-        for image_path in images:
+        for image_path, (face_name, distance) in zip(images, predictions):
             print(image_path)
-            # predict name
-            image = cv2.imread(image_path)
-            face_name, distance = self.predict(image)
             # if the confidence is less than the threshold skip
             if distance < self.auto_train_dist:
                 os.remove(image_path)
@@ -473,44 +574,129 @@ class FaceRecognizer(Thread):
 
         return recognizer
 
-    def name_from_label(self, label):
-        """Function to get the person name by the label"""
+    def load_engine(self):
+        """Return the numpy engine with the saved model, the model is migrated from the opencv one the first time"""
+
+        engine = LbphEngine(size=self.image_size)
+        params = (engine.radius, engine.neighbors, engine.grid_x, engine.grid_y)
+
+        self.store = None
+        if os.path.exists(self.engine_path):
+            try:
+                self.store = ModelStore(self.engine_path, *params)
+            except ValueError as e:
+                # saved with other parameters or corrupted, keep it aside and start again from the opencv model
+                print("Cannot load the model, moving it to " + self.engine_path + ".bad : " + str(e))
+                os.replace(self.engine_path, self.engine_path + ".bad")
+
+        if self.store is None:
+            self.store = self.migrate_engine(params)
+        # the samples trained since the failed migration are kept, the opencv ones are added to them
+        elif os.path.exists(self.migration_path) and self.migrate_yaml(self.store):
+            os.remove(self.migration_path)
+
+        histograms, labels = self.store.load()
+        engine.set_model(histograms, labels)
+
+        return engine
 
-        # take all the direcories
-        dirs = glob.glob(self.faces_dir + "s_" + str(label) + "_*")
+    def migrate_engine(self, params):
+        """Return a new ModelStore with the samples of the opencv model. The store is written aside and takes the place
+        of engine_path once migrated. If the migration fails it takes its place all the same, so that the samples
+        trained meanwhile are kept, and migration_path marks the migration to be tried again at the next start"""
 
-        # if there are none return false
-        if len(dirs) == 0:
+        tmp_path = self.engine_path + ".migrating"
+        # left by a migration interrupted, it never held trained samples
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        store = ModelStore(tmp_path, *params)
+
+        if self.migrate_yaml(store):
+            if os.path.exists(self.migration_path):
+                os.remove(self.migration_path)
+        else:
+            open(self.migration_path, "w").close()
+
+        store.move(self.engine_path)
+        return store
+
+    def migrate_yaml(self, store):
+        """Append the samples of the opencv model to the store, return False if the model could not be read"""
+
+        if not os.path.exists(self.recognizer_path):
+            return True
+
+        print("Migrating the model from " + self.recognizer_path + "...")
+        try:
+            store.migrate_yaml(self.recognizer_path)
+        # a broken file may come as a SystemError from the cv2 bindings
+        except (cv2.error, AttributeError, ValueError, SystemError) as e:
+            print("Cannot migrate the model, it will be tried again at the next start : " + str(e))
             return False
+
+        return True
+
+    def load_model(self):
+        """Load the model of the recognizer in use"""
+
+        if self.recognizer_type == "numpy":
+            self.engine = self.load_engine()
         else:
-            dirs = dirs[0]
+            self.recognizer = self.load_recognizer()
+
+    def update_engine(self, faces, labels):
+        """Add the faces to the model store, then give the engine the new model"""
+
+        self.store.append(self.engine.histograms(faces), labels)
+
+        histograms, labels = self.store.load()
+        self.engine.set_model(histograms, labels, self.engine.model[2])
+
+    def update_recognizer(self, faces, labels):
+        """Update a copy of the opencv recognizer with the faces, save it and then replace the one in use"""
+
+        recognizer = self.load_recognizer()
+        recognizer.update(faces, np.array(labels))
+        recognizer.save(self.recognizer_path)
+
+        self.recognizer = recognizer
+
+    def save_model(self):
+        """Save the model of the recognizer in use, the model store commits every update already"""
 
-        # get the name
+        if self.recognizer_type != "numpy":
+            self.recognizer.save(self.recognizer_path)
 
-        return dirs.split("_")[-1]
+    def model_stats(self):
+        """Return a string with the size of the model"""
+
+        if self.recognizer_type != "numpy":
+            return "opencv LBPH, " + self.recognizer_path
+
+        return str(self.store.count) + " samples, " + str(round(self.store.size() / 2 ** 20, 1)) + " MB"
+
+    def name_from_label(self, label):
+        """Function to get the person name by the label"""
+
+        return self.registry.name(label)
 
     def prepare_training_data(self):
         """Get the saved images from the Faces direcotry, treat them and return two lists with the same lenght:
         faces : list of images with faces in them
         labels : list of labels for each face """
 
-        # ------STEP-1--------
-        # get the directories (one directory for each subject) in data folder
-        dirs = glob.glob(self.faces_dir + "s_*")
-
         # list to hold all subject faces
         faces = []
         # list to hold labels for all subjects
         labels = []
 
-        # let's go through each directory and read images within it
-        for dir_name in dirs:
-            # print(dir_name)
-            # get the subject label (number)
-            label = int(dir_name.split("/")[-1].split("_")[1])
+        # let's go through the directories with new images (one directory for each subject) and read images within it
+        for label, dir_name in self.registry.training_dirs():
+            images = 0
 
             # for every image in the direcotry append image,label
-            for image_path in glob.glob(dir_name + "/*.png"):
+            for image_path in glob.glob(dir_name + "*.png"):
                 # read the image
                 image = cv2.imread(image_path)
                 # convert to gray scale
@@ -520,6 +706,9 @@ class FaceRecognizer(Thread):
                 labels.append(label)
                 # remove image
                 os.remove(image_path)
+                images += 1
+
+            self.registry.trained(label, images)
 
         return faces, labels
 
@@ -559,34 +748,29 @@ class FaceRecognizer(Thread):
 
         return inline
 
-    def add_image_write(self, image_list, subject_name=""):
-
-        # currently used only for the unknown direcotry
-        subject_name = "Unknown"
+    def add_image_write(self, image_list):
+        """Write the images in the Unknown directory, never overwriting the images already there"""
 
         print("Adding face images to unknown folder...")
 
-        # look for the direcotry and create it if not present
-        if not glob.glob(self.faces_dir + subject_name):
+        # look for the direcotry
+        dir = self.unknown
+        if not os.path.isdir(dir):
             return False
-            # self.add_folder(subject_name)
 
-        # get the directory name
-        dir = self.get_name_dir(subject_name)
-
-        if not dir:
-            return False
-        else:
-            dir = self.faces_dir + dir + "/"
-
-        # get the length of the images in the directory
-        idx = len([name for name in os.listdir(dir) if os.path.isfile(name)])
-
-        for image in image_list:
-            image_name = dir + "image_" + str(idx) + ".png"
-            cv2.resize(image, self.image_size)
-            cv2.imwrite(image_name, image)
-            idx += 1
+        # more events can be writing their images at once
+        with self.unknown_lock:
+            idx = 0
+            for image in image_list:
+                # take the next free name
+                image_name = dir + "image_" + str(idx) + ".png"
+                while os.path.exists(image_name):
+                    idx += 1
+                    image_name = dir + "image_" + str(idx) + ".png"
+
+                cv2.resize(image, self.image_size)
+                cv2.imwrite(image_name, image)
+                idx += 1
 
         print("...Done")
 
@@ -599,56 +783,32 @@ class FaceRecognizer(Thread):
         # look for the direcotry and create it if not present
         print(subject_name)
         subject_name = subject_name.strip()
-        if not subject_name in os.listdir(self.faces_dir):
-            self.add_folder(subject_name)
-            return
-
-        # get the directory name
-        dir = self.get_name_dir(subject_name)
+        self.add_folder(subject_name)
 
-        if not dir:
+        try:
+            return bool(self.registry.add_image(subject_name, image))
+        except FileNotFoundError:
             return False
-        else:
-            dir = self.faces_dir + dir + "/"
-
-        # get the length of the images in the directory
-        idx = len([name for name in os.listdir(dir) if os.path.isfile(name)])
-
-        image_name = dir + "image_" + str(idx) + ".png"
-
-        os.rename(image, image_name)
-
-        return True
 
     def add_folder(self, name):
         """Create a folder for the new person"""
 
-        if not name in os.listdir(self.faces_dir):
-            # get how many folder there are in the faces dir
-            idx = len(glob.glob(self.faces_dir + 's_*'))
-            # generate the name
-            name = "s_" + str(idx) + "_" + name
-            # create the directory
-            os.makedirs(self.faces_dir + name)
+        # the registry gives the next label to the new subject and creates the s_label_name directory
+        return self.registry.add(name)
 
     def get_name_dir(self, subject_name):
+        """Return the directory name of the subject, False if not found"""
 
-        for dir in os.listdir(self.faces_dir):
-            if subject_name in dir:
-                return dir
+        directory = self.registry.directory(subject_name)
+        if not directory:
+            return False
 
-        return False
+        return directory.split("/")[-2]
 
     def get_dir_subjects(self):
         """Function to get all the names saved in the faces direcotry"""
 
-        s_names = []
-
-        import glob
-        for name in glob.glob(self.faces_dir + 's_*'):
-            s_names.append(name.split("_")[2])
-
-        return s_names
+        return self.registry.names()
 
 # uncomment and add token to debug face recognition
 # updater = Updater("")
@@ -0,0 +1,212 @@
+import glob
+import os
+import threading
+
+
+class SubjectRegistry:
+    """In memory index of the subjects known by the face recognizer, so that the Faces directory is not listed every
+    time a label has to be turned into a name.
+    Every subject has a directory inside faces_dir named s_label_name, the registry keeps for every label the name,
+    the directory, the number of images waiting to be trained on and the number of images trained on.
+    The registry is loaded once from index_path, a text file with one label,name,images,trained line per subject, and
+    rebuilt from the directories when the file is missing or out of date. The images waiting are counted again on the
+    disk at loading and before every training, so the ones copied by hand are trained on too. Every change is done on
+    the disk first, then in memory and in the index file, which is replaced atomically
+
+    Attributes:
+        faces_dir : the directory with the subject directories
+        index_path : the path of the index file
+        subjects : the dictionary label -> {"name", "dir", "images", "trained"}
+        labels : the dictionary name -> label
+        lock : lock for the subjects
+
+    """
+
+    def __init__(self, faces_dir, index_path=None):
+        self.faces_dir = faces_dir
+        self.index_path = faces_dir + "index" if index_path is None else index_path
+
+        self.subjects = {}
+        self.labels = {}
+        self.lock = threading.RLock()
+
+        self.load()
+
+    # ===================LOADING=========================
+
+    def load(self):
+        """Load the index file, rebuild it from the directories when it does not match them"""
+
+        with self.lock:
+            self.subjects = {}
+            self.labels = {}
+
+            try:
+                with open(self.index_path, "r") as file:
+                    for line in file:
+                        label, name, images, trained = line.strip("\n").split(",")
+                        self.set(int(label), name, int(images), int(trained))
+            except (IOError, ValueError):
+                self.rebuild()
+                return
+
+            # subjects added or removed by hand
+            dirs = set(os.path.basename(path) for path in glob.glob(self.faces_dir + "s_*"))
+            if dirs != set(subject["dir"] for subject in self.subjects.values()):
+                self.rebuild()
+                return
+
+            # images added or removed by hand
+            self.count_images()
+
+    def count_images(self):
+        """Count the images waiting in every subject directory, saving the index if they changed"""
+
+        with self.lock:
+            changed = False
+            for subject in self.subjects.values():
+                images = len(glob.glob(self.faces_dir + subject["dir"] + "/*.png"))
+                if images != subject["images"]:
+                    subject["images"] = images
+                    changed = True
+
+            if changed:
+                self.save()
+
+    def rebuild(self):
+        """Build the registry from the subject directories and save it"""
+
+        with self.lock:
+            trained = dict((label, subject["trained"]) for label, subject in self.subjects.items())
+            self.subjects = {}
+            self.labels = {}
+
+            for path in glob.glob(self.faces_dir + "s_*"):
+                try:
+                    _, label, name = os.path.basename(path).split("_", 2)
+                    label = int(label)
+                except ValueError:
+                    continue
+
+                images = len(glob.glob(path + "/*.png"))
+                self.set(label, name, images, trained.get(label, 0))
+
+            self.save()
+
+    def set(self, label, name, images, trained):
+        """Store a subject in memory"""
+
+        self.subjects[label] = {"name": name, "dir": "s_" + str(label) + "_" + name, "images": images,
+                                "trained": trained}
+        self.labels[name] = label
+
+    def save(self):
+        """Write the index file, replacing the old one only once the new one is complete"""
+
+        with self.lock:
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, "w") as file:
+                for label in sorted(self.subjects):
+                    subject = self.subjects[label]
+                    file.write(str(label) + "," + subject["name"] + "," + str(subject["images"]) + "," + str(
+                        subject["trained"]) + "\n")
+            os.replace(tmp_path, self.index_path)
+
+    # ===================QUERIES=========================
+
+    def name(self, label):
+        """Return the name of the subject with label, False if there is none"""
+
+        subject = self.subjects.get(label)
+        if subject is None:
+            return False
+        return subject["name"]
+
+    def label(self, name):
+        """Return the label of the subject called name, None if there is none"""
+        return self.labels.get(name)
+
+    def directory(self, name):
+        """Return the path of the directory of the subject called name, False if there is none"""
+
+        with self.lock:
+            label = self.labels.get(name)
+            if label is None:
+                return False
+            return self.faces_dir + self.subjects[label]["dir"] + "/"
+
+    def names(self):
+        """Return the names of the subjects, by label"""
+
+        with self.lock:
+            return [self.subjects[label]["name"] for label in sorted(self.subjects)]
+
+    def training_dirs(self):
+        """Return the (label, directory path) of the subjects with images to train on"""
+
+        with self.lock:
+            self.count_images()
+            return [(label, self.faces_dir + subject["dir"] + "/") for label, subject in sorted(self.subjects.items())
+                    if subject["images"] > 0]
+
+    # ===================CHANGES=========================
+
+    def add(self, name):
+        """Create the directory of a new subject and return its label, the label of the subject if it exists already"""
+
+        with self.lock:
+            if name in self.labels:
+                return self.labels[name]
+
+            label = max(self.subjects) + 1 if self.subjects else 0
+            os.makedirs(self.faces_dir + "s_" + str(label) + "_" + name)
+
+            self.set(label, name, 0, 0)
+            self.save()
+
+            return label
+
+    def add_image(self, name, image_path):
+        """Move the image in the directory of the subject called name and return its new path, False if the subject
+        does not exist. Raise FileNotFoundError when the image does not exist"""
+
+        with self.lock:
+            label = self.labels.get(name)
+            if label is None:
+                return False
+
+            subject = self.subjects[label]
+
+            # the images added while a training was reading the directory are still there
+            idx = subject["images"]
+            new_path = self.faces_dir + subject["dir"] + "/image_" + str(idx) + ".png"
+            while os.path.exists(new_path):
+                idx += 1
+                new_path = self.faces_dir + subject["dir"] + "/image_" + str(idx) + ".png"
+
+            os.rename(image_path, new_path)
+
+            subject["images"] += 1
+            self.save()
+
+            return new_path
+
+    def trained(self, label, images):
+        """Record that the images of the subject with label have been trained on and removed"""
+
+        with self.lock:
+            subject = self.subjects.get(label)
+            if subject is None:
+                return
+
+            subject["images"] = max(0, subject["images"] - images)
+            subject["trained"] += images
+            self.save()
+
+    def stats(self):
+        """Return a string with the number of subjects and images"""
+
+        with self.lock:
+            return str(len(self.subjects)) + " subjects, " + str(
+                sum(subject["trained"] for subject in self.subjects.values())) + " images trained, " + str(
+                sum(subject["images"] for subject in self.subjects.values())) + " waiting"
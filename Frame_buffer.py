@@ -0,0 +1,782 @@
+import collections
+import itertools
+import os
+import queue
+import threading
+from threading import Thread
+from time import time
+
+import cv2
+import numpy as np
+
+
+class FrameRecord:
+    """A captured frame with its sequence number and capture time.
+    The grayscale plane is computed lazily the first time it is asked for and then kept, so no consumer has to convert
+    the same frame twice. Records coming from a FrameRing share the grayscale plane through the ring itself
+
+    Attributes:
+        seq : the sequence number of the frame, -1 for frames not coming from the camera
+        timestamp : the capture time in seconds since the epoch
+        bgr : the bgr image (a view on the ring slot when ring is not None)
+        ring : the FrameRing holding the frame, None for detached records
+        gray_plane : the cached grayscale image, None until computed
+
+    """
+
+    def __init__(self, bgr, seq=-1, timestamp=None, ring=None, gray=None):
+        self.seq = seq
+        self.timestamp = time() if timestamp is None else timestamp
+        self.bgr = bgr
+        self.ring = ring
+        self.gray_plane = gray
+
+    @property
+    def gray(self):
+        """The grayscale image, computed once. None if the frame has been overwritten in the ring before being
+        grayscaled, the consumers skip it"""
+
+        if self.gray_plane is None:
+            if self.ring is not None:
+                self.gray_plane = self.ring.gray(self.seq)
+            else:
+                self.gray_plane = cv2.cvtColor(self.bgr, cv2.COLOR_BGR2GRAY)
+
+        return self.gray_plane
+
+    def valid(self):
+        """Check if the frame has not been overwritten, detached records are always valid"""
+        return self.ring is None or self.ring.valid(self.seq)
+
+    def copy(self):
+        """Return a detached copy of the record, None if the frame has been overwritten before or during the copy"""
+
+        bgr = self.bgr.copy()
+        gray = None if self.gray_plane is None else self.gray_plane.copy()
+
+        # the writer may have reused the slot while copying
+        if not self.valid():
+            return None
+
+        return FrameRecord(bgr, self.seq, self.timestamp, gray=gray)
+
+
+class FrameRing:
+    """Fixed capacity ring of camera frames shared between the threads.
+    The frames live in a preallocated numpy array so the camera can write straight into the next slot instead of
+    allocating a new image for every read. Every committed frame gets a monotonic sequence number, readers get a
+    FrameRecord whose images are views on the slot (no copy).
+
+    A view stays valid until the writer wraps around the ring and reuses its slot, that is for capacity-1 frames.
+    Readers holding a frame for longer than that should copy the record, or check valid() once they are done with it.
+    Readers can block on wait_for_frame until a frame newer than the last one they processed is committed.
+
+    Attributes:
+        capacity : the number of slots in the ring
+        shape : the (height, width, channels) shape of the frames
+        storage : the preallocated bgr frames
+        gray_storage : the preallocated grayscaled frames, filled the first time a reader asks for them
+        seqs : the sequence number held by every slot, -1 when the slot is empty or being written
+        gray_seqs : the sequence number the grayscaled slot has been computed for
+        timestamps : the capture time of every slot
+        last_seq : the sequence number of the last committed frame, -1 when no frame has been committed yet
+        lock : the condition keeping seqs and last_seq consistent between the writer and the readers, it is notified
+            on every commit
+        gray_locks : one lock per slot, so that the grayscale conversion is done once
+
+    """
+
+    def __init__(self, capacity=10, shape=(480, 640, 3)):
+
+        self.capacity = capacity
+        self.shape = shape
+
+        self.storage = np.zeros((capacity,) + tuple(shape), dtype=np.uint8)
+        self.gray_storage = np.zeros((capacity,) + tuple(shape[:2]), dtype=np.uint8)
+        self.seqs = np.full(capacity, -1, dtype=np.int64)
+        self.gray_seqs = np.full(capacity, -1, dtype=np.int64)
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.last_seq = -1
+
+        self.lock = threading.Condition()
+        self.gray_locks = [threading.Lock() for _ in range(capacity)]
+
+    def next_slot(self):
+        """Return the slot the next frame has to be written into. The slot is invalidated so that readers still
+        holding the frame it contained can notice it has been overwritten. Only one writer is supported"""
+
+        idx = (self.last_seq + 1) % self.capacity
+        with self.lock:
+            self.seqs[idx] = -1
+
+        return self.storage[idx]
+
+    def commit(self, img, timestamp=None):
+        """Commit the frame written in the slot returned by next_slot and return its sequence number.
+        If img is not the slot itself (the capture object may allocate a new image) it is copied into the slot"""
+
+        seq = self.last_seq + 1
+        idx = seq % self.capacity
+        slot = self.storage[idx]
+
+        # the camera did not write in place, copy (or resize) the image into the slot
+        if not np.may_share_memory(img, slot):
+            if img.shape != slot.shape:
+                cv2.resize(img, (self.shape[1], self.shape[0]), dst=slot)
+            else:
+                np.copyto(slot, img)
+
+        with self.lock:
+            self.timestamps[idx] = time() if timestamp is None else timestamp
+            self.seqs[idx] = seq
+            self.last_seq = seq
+            self.lock.notify_all()
+
+        return seq
+
+    def valid(self, seq):
+        """Check if the frame with sequence number seq is still in the ring"""
+        return seq >= 0 and self.seqs[seq % self.capacity] == seq
+
+    def get(self, seq):
+        """Return the FrameRecord for the sequence number seq, None if it is not in the ring anymore"""
+
+        if not self.valid(seq):
+            return None
+
+        idx = seq % self.capacity
+        return FrameRecord(self.storage[idx], seq, self.timestamps[idx], ring=self)
+
+    def latest(self):
+        """Return the FrameRecord of the last committed frame, None if the ring is empty"""
+
+        with self.lock:
+            seq = self.last_seq
+
+        return self.get(seq)
+
+    def wait_for_frame(self, after_seq, timeout=None):
+        """Block until a frame with sequence number greater than after_seq is committed and return the FrameRecord of
+        the last committed frame. Return None if timeout seconds pass without new frames"""
+
+        with self.lock:
+            if not self.lock.wait_for(lambda: self.last_seq > after_seq, timeout):
+                return None
+            seq = self.last_seq
+
+        return self.get(seq)
+
+    def gray(self, seq):
+        """Return a view on the grayscaled frame with sequence number seq, converting it only the first time.
+        Return None if the frame is not in the ring anymore"""
+
+        idx = seq % self.capacity
+
+        with self.gray_locks[idx]:
+            if not self.valid(seq):
+                return None
+
+            if self.gray_seqs[idx] != seq:
+                cv2.cvtColor(self.storage[idx], cv2.COLOR_BGR2GRAY, dst=self.gray_storage[idx])
+                self.gray_seqs[idx] = seq
+
+        return self.gray_storage[idx]
+
+    def copy(self, seq=None):
+        """Return a detached copy of the record with sequence number seq (default the last one), None if the frame has
+        been overwritten before or during the copy"""
+
+        record = self.latest() if seq is None else self.get(seq)
+        if record is None:
+            return None
+
+        return record.copy()
+
+    def clear(self):
+        """Empty the ring, the sequence numbers keep growing"""
+        with self.lock:
+            self.seqs.fill(-1)
+
+
+class MemoryBudget:
+    """The memory shared by all the RecordingSession alive, the one recording and the ones waiting for or being
+    post-processed, so that a burst of events cannot hold more than max_bytes of frames altogether.
+    The sessions charge the frames they keep in memory (raw, pending and jpeg, not the ones spilled on disk) and drop the
+    ones not fitting, they release them when closed. The EventPipeline waits for room before taking a new event
+
+    Attributes:
+        max_bytes : the bytes all the sessions can hold in memory
+        used : the bytes charged
+        peak : the maximum bytes charged at once
+        refused : the number of charges refused because the budget was full
+        lock : the condition for the counters, notified on every release
+
+    """
+
+    def __init__(self, max_bytes=256 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.peak = 0
+        self.refused = 0
+
+        self.lock = threading.Condition()
+
+    def charge(self, size):
+        """Charge size bytes, return False if they do not fit"""
+
+        with self.lock:
+            if self.used + size > self.max_bytes:
+                self.refused += 1
+                return False
+
+            self.used += size
+            self.peak = max(self.peak, self.used)
+            return True
+
+    def release(self, size):
+        """Give back size bytes charged before"""
+
+        with self.lock:
+            self.used -= size
+            self.lock.notify_all()
+
+    def free(self):
+        """Return the bytes that can still be charged"""
+        return self.max_bytes - self.used
+
+    def wait_for_room(self, size, timeout=None):
+        """Block until size bytes can be charged, return False if timeout seconds passed first"""
+
+        with self.lock:
+            return self.lock.wait_for(lambda: self.used + size <= self.max_bytes, timeout)
+
+    def stats(self):
+        """Return a string with the budget metrics"""
+
+        return "used " + str(round(self.used / 2 ** 20, 1)) + "/" + str(
+            round(self.max_bytes / 2 ** 20, 1)) + " MB (max " + str(round(self.peak / 2 ** 20, 1)) + "), refused " + str(
+            self.refused)
+
+
+class RecordingSession:
+    """The frames captured during an event, kept under a memory budget.
+    The frames are copied raw until max_raw_bytes is reached, then depending on overflow:
+        jpeg : the frames are jpeg encoded and kept in memory
+        disk : the frames are jpeg encoded and written to spill_dir
+        decimate : only one frame every decimation is kept raw
+    With a SessionCompressor the frames to encode are stored raw as pending and handed over to it, so that the thread
+    adding the frames (the camera one) never encodes nor writes them. Without it they are encoded by add.
+    Once max_bytes is reached (compressed frames included) the new frames are dropped, and so are the ones not fitting
+    in the MemoryBudget shared with the other sessions.
+    Iterating over the session returns detached FrameRecord, decoding the compressed frames on the fly.
+    Consumers can follow a session while it is still recording with wait_for_index, until end is called
+
+    Attributes:
+        max_raw_bytes : the memory budget for the raw frames
+        max_bytes : the budget for all the frames held, both in memory and on disk
+        overflow : what to do once max_raw_bytes is reached, one of jpeg, disk, decimate
+        jpeg_quality : the jpeg quality (0-100) of the compressed frames
+        decimation : in decimate mode keep one frame every decimation
+        spill_dir : the directory for the disk mode
+        compressor : the SessionCompressor encoding the frames over the raw budget, None to encode them in add
+        budget : the MemoryBudget charged with the frames held in memory, None for no shared budget
+        entries : the list of stored frames as (seq, timestamp, kind, data), kind is one of raw, jpeg, file, pending
+            (raw, waiting for the compressor)
+        meta : a dictionary for every stored frame, where the consumers keep what they found in it (faces, movement...)
+        event_id : a number identifying the session, unique for the process
+        motion : the movement found by the detector while recording, as (seq, dictionary) in seq order, see motion_at
+        summary : a dictionary where the consumers keep what they found about the whole recording (the objects moving...)
+        raw_bytes : the bytes held by the raw frames
+        compressed_bytes : the bytes held by the jpeg frames, in memory or on disk
+        pending_bytes : the bytes held by the raw frames waiting for the compressor
+        pending_frames : the number of frames waiting for the compressor
+        charged : the bytes charged to the budget, released on close
+        frames_seen : the frames offered to the session
+        frames_spilled : the frames stored compressed
+        frames_dropped : the frames not stored at all
+        preroll_frames : the frames taken from before the recording started, they are the first ones
+        ended : True once the recording is over and no more frames will be added
+        ended_at : the time the recording ended, None while recording
+        lock : the condition for the entries, it is notified on every stored frame, every motion added and when the
+            recording ends. Who changes the meta should call notify
+
+    """
+
+    ids = itertools.count()
+
+    def __init__(self, max_raw_bytes=64 * 2 ** 20, max_bytes=128 * 2 ** 20, overflow="jpeg", jpeg_quality=90,
+                 decimation=3, spill_dir="Resources/recording/", compressor=None, budget=None):
+
+        self.max_raw_bytes = max_raw_bytes
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+        self.jpeg_quality = jpeg_quality
+        self.decimation = decimation
+        self.spill_dir = spill_dir
+        self.compressor = compressor
+        self.budget = budget
+
+        self.entries = []
+        self.meta = []
+        self.motion = []
+        self.summary = {}
+        self.event_id = next(RecordingSession.ids)
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.pending_bytes = 0
+        self.pending_frames = 0
+        self.charged = 0
+        self.frames_seen = 0
+        self.frames_spilled = 0
+        self.frames_dropped = 0
+        self.preroll_frames = 0
+        self.ended = False
+        self.ended_at = None
+
+        self.lock = threading.Condition()
+
+    @property
+    def bytes_held(self):
+        """The bytes of all the frames held"""
+        return self.raw_bytes + self.compressed_bytes + self.pending_bytes
+
+    def compressed_size(self, raw_size):
+        """Return the expected bytes of a frame of raw_size bytes once compressed, from the frames compressed so far"""
+
+        if self.frames_spilled:
+            return self.compressed_bytes / self.frames_spilled
+        return raw_size / 10
+
+    def charge(self, size):
+        """Charge size bytes of memory to the budget, return False if they do not fit"""
+
+        if self.budget is not None and not self.budget.charge(size):
+            return False
+
+        with self.lock:
+            self.charged += size
+        return True
+
+    def release(self, size):
+        """Give back to the budget size bytes charged before, to be called with the lock held"""
+
+        self.charged -= size
+        if self.budget is not None:
+            self.budget.release(size)
+
+    def add(self, record):
+        """Store a FrameRecord, return False if it has been dropped or the recording has ended. Frames older than the
+        last one stored are ignored, so the same frame can be offered twice"""
+
+        # the shotter may offer a frame while the recording is being ended, holding the lock no frame comes after end
+        with self.lock:
+            if self.ended:
+                return False
+            return self.store(record)
+
+    def store(self, record):
+        """Store a FrameRecord as raw, pending or compressed, called by add with the lock held"""
+
+        if self.entries and record.seq <= self.entries[-1][0]:
+            return False
+
+        self.frames_seen += 1
+        size = record.bgr.nbytes
+
+        # there is room for the raw frame
+        if self.raw_bytes + size <= self.max_raw_bytes:
+            if not self.charge(size):
+                self.frames_dropped += 1
+                return False
+
+            entry = (record.seq, record.timestamp, "raw", record.bgr.copy())
+            self.raw_bytes += size
+
+        elif self.overflow == "decimate":
+            if self.frames_seen % self.decimation or self.bytes_held + size > self.max_bytes or not self.charge(size):
+                self.frames_dropped += 1
+                return False
+
+            entry = (record.seq, record.timestamp, "raw", record.bgr.copy())
+            self.raw_bytes += size
+
+        elif self.compressor is not None:
+            # the frames waiting are expected to take as much as the ones compressed already
+            expected = self.compressed_bytes + (self.pending_frames + 1) * self.compressed_size(size)
+            if expected > self.max_bytes or not self.compressor.has_room() or not self.charge(size):
+                self.frames_dropped += 1
+                return False
+
+            entry = (record.seq, record.timestamp, "pending", record.bgr.copy())
+
+        else:
+            data, entry = self.encode(record.seq, record.timestamp, record.bgr)
+            # the frames spilled on disk do not take memory
+            if data is None or self.bytes_held + len(data) > self.max_bytes or (
+                    entry[2] == "jpeg" and not self.charge(len(data))):
+                if entry is not None and entry[2] == "file":
+                    os.remove(entry[3])
+                self.frames_dropped += 1
+                return False
+
+            self.compressed_bytes += len(data)
+            self.frames_spilled += 1
+
+        with self.lock:
+            # the compressor changes the counters too
+            if entry[2] == "pending":
+                self.pending_bytes += size
+                self.pending_frames += 1
+
+            idx = len(self.entries)
+            self.meta.append({})
+            self.entries.append(entry)
+            self.lock.notify_all()
+
+        if entry[2] == "pending":
+            self.compressor.submit(self, idx)
+
+        return True
+
+    def encode(self, seq, timestamp, bgr):
+        """Jpeg encode a frame, writing it to spill_dir in disk mode. Return the tuple (data, entry), (None, None) if the
+        encoding failed"""
+
+        ret, data = cv2.imencode(".jpg", bgr, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        if not ret:
+            return None, None
+
+        if self.overflow == "disk":
+            if not os.path.isdir(self.spill_dir):
+                os.makedirs(self.spill_dir)
+            path = os.path.join(self.spill_dir, str(id(self)) + "_" + str(seq) + ".jpg")
+            with open(path, "wb") as file:
+                file.write(data.tobytes())
+            return data, (seq, timestamp, "file", path)
+
+        return data, (seq, timestamp, "jpeg", data)
+
+    def compress(self, idx):
+        """Replace the idx-th frame, pending, with its compressed version. Called by the SessionCompressor"""
+
+        with self.lock:
+            if idx >= len(self.entries) or self.entries[idx][2] != "pending":
+                return
+            pending = self.entries[idx]
+
+        seq, timestamp, _, bgr = pending
+        data, entry = self.encode(seq, timestamp, bgr)
+
+        with self.lock:
+            # the session has been closed meanwhile
+            if idx >= len(self.entries) or self.entries[idx] is not pending:
+                if entry is not None and entry[2] == "file":
+                    os.remove(entry[3])
+                return
+
+            self.pending_bytes -= bgr.nbytes
+            self.pending_frames -= 1
+
+            # the frame stays raw when it cannot be encoded
+            if data is None:
+                self.entries[idx] = (seq, timestamp, "raw", bgr)
+                self.raw_bytes += bgr.nbytes
+                return
+
+            # the raw frame was charged, the jpeg one is smaller
+            self.release(bgr.nbytes - len(data) if entry[2] == "jpeg" else bgr.nbytes)
+            self.entries[idx] = entry
+            self.compressed_bytes += len(data)
+            self.frames_spilled += 1
+
+    def add_encoded(self, seq, timestamp, data):
+        """Store a frame already jpeg encoded, return False if it has been dropped or the recording has ended"""
+
+        with self.lock:
+            if self.ended or (self.entries and seq <= self.entries[-1][0]):
+                return False
+
+            self.frames_seen += 1
+
+            if self.bytes_held + len(data) > self.max_bytes or not self.charge(len(data)):
+                self.frames_dropped += 1
+                return False
+
+            self.compressed_bytes += len(data)
+
+            self.meta.append({})
+            self.entries.append((seq, timestamp, "jpeg", data))
+            self.lock.notify_all()
+
+        return True
+
+    def end(self):
+        """Mark the recording as over, waking up the consumers waiting for new frames"""
+
+        with self.lock:
+            self.ended = True
+            self.ended_at = time()
+            self.lock.notify_all()
+
+    def notify(self):
+        """Wake up the consumers waiting on the session, after the meta of a frame has been changed"""
+
+        with self.lock:
+            self.lock.notify_all()
+
+    def wait_for(self, predicate, timeout=None):
+        """Block until predicate() is True, checking it every time the session changes. Return the last predicate
+        value, so False when timeout seconds passed"""
+
+        with self.lock:
+            return self.lock.wait_for(predicate, timeout)
+
+    def wait_for_index(self, idx, timeout=None):
+        """Block until the idx-th frame is stored, return False if the recording ended without it or timeout seconds
+        passed"""
+
+        return self.wait_for(lambda: idx < len(self.entries) or self.ended, timeout) and idx < len(self.entries)
+
+    def frame(self, idx):
+        """Return the idx-th stored frame as a detached FrameRecord"""
+
+        with self.lock:
+            seq, timestamp, kind, data = self.entries[idx]
+
+        if kind == "raw" or kind == "pending":
+            img = data
+        elif kind == "jpeg":
+            img = cv2.imdecode(data, cv2.IMREAD_COLOR)
+        else:
+            img = cv2.imread(data)
+
+        return FrameRecord(img, seq, timestamp)
+
+    def add_motion(self, seq, motion):
+        """Keep what the detector found (a dictionary with the motion boxes, contours...) in the frame with sequence
+        number seq, the frames must be added in seq order"""
+
+        with self.lock:
+            self.motion.append((seq, motion))
+            self.lock.notify_all()
+
+    def motion_at(self, seq):
+        """Return the motion dictionary of the last frame analyzed by the detector up to seq, None if there is none.
+        The detector does not analyze every frame, so the stored frames share the motion of the frame analyzed before
+        them"""
+
+        # the detector is usually just behind the frame asked for, so look from the end
+        for motion_seq, motion in reversed(self.motion):
+            if motion_seq <= seq:
+                return motion
+
+        return None
+
+    def has_motion_for(self, seq):
+        """Check if the detector analyzed the frame with sequence number seq or a later one"""
+        return len(self.motion) > 0 and self.motion[-1][0] >= seq
+
+    def last_motion(self):
+        """Return the last motion dictionary added, None if there is none"""
+        return self.motion[-1][1] if self.motion else None
+
+    def seqs(self):
+        """Return the sequence numbers of the stored frames"""
+
+        with self.lock:
+            return [entry[0] for entry in self.entries]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self.frame(idx)
+
+    def close(self):
+        """Free the frames, deleting the spilled files"""
+
+        with self.lock:
+            for _, _, kind, data in self.entries:
+                if kind == "file":
+                    try:
+                        os.remove(data)
+                    except FileNotFoundError:
+                        pass
+
+            self.entries = []
+            self.meta = []
+            self.motion = []
+            self.raw_bytes = 0
+            self.compressed_bytes = 0
+            self.pending_bytes = 0
+            self.pending_frames = 0
+            self.release(self.charged)
+            self.ended = True
+            self.lock.notify_all()
+
+    def stats(self):
+        """Return a string with the session metrics"""
+
+        return "frames " + str(len(self)) + "/" + str(self.frames_seen) + ", pre-roll " + str(
+            self.preroll_frames) + ", spilled " + str(
+            self.frames_spilled) + ", compressing " + str(self.pending_frames) + ", dropped " + str(
+            self.frames_dropped) + ", held " + str(
+            round(self.bytes_held / 2 ** 20, 1)) + " MB"
+
+
+class SessionCompressor(Thread):
+    """Thread compressing the frames the RecordingSession stored over their raw budget, so that the camera thread
+    adding them does not wait for the jpeg encoding and the disk writes. The sessions hand over the index of their
+    pending frames, when more than max_pending frames are waiting the sessions drop the new ones
+
+    Attributes:
+        max_pending : the maximum number of frames waiting to be compressed
+        jobs : the queue of the (session, frame index) to compress
+        compressed : the number of frames compressed
+        stop_event : the event to handle thread stopping
+
+    """
+
+    def __init__(self, max_pending=50):
+        Thread.__init__(self, name="SessionCompressor")
+
+        self.max_pending = max_pending
+        self.jobs = queue.Queue()
+        self.compressed = 0
+
+        self.stop_event = threading.Event()
+
+    def has_room(self):
+        """Check if another frame can be handed over"""
+        return self.jobs.qsize() < self.max_pending
+
+    def submit(self, session, idx):
+        """Queue the idx-th frame of the session"""
+        self.jobs.put((session, idx))
+
+    def run(self):
+
+        while not self.stopped():
+            try:
+                session, idx = self.jobs.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            session.compress(idx)
+            self.compressed += 1
+
+    def stop(self):
+        self.stop_event.set()
+
+    def stopped(self):
+        return self.stop_event.is_set()
+
+
+class PreRollBuffer(Thread):
+    """Thread keeping the last seconds of frames of a FrameRing jpeg compressed, so that the recordings can start
+    before the moment they are asked for. The frames are encoded as they are committed, skipping the ones committed
+    while encoding when the worker is late, and the oldest are dropped past seconds or max_bytes
+
+    Attributes:
+        ring : the FrameRing to follow
+        seconds : how many seconds of frames to keep
+        max_bytes : the memory budget for the compressed frames
+        jpeg_quality : the jpeg quality (0-100) of the frames
+        frames : the compressed frames as (seq, timestamp, data), from the oldest
+        bytes : the bytes held by the compressed frames
+        raw_bytes : the bytes the same frames would hold uncompressed
+        last_seq : the sequence number of the last frame encoded
+        lock : lock for the frames
+        stop_event : the event to handle thread stopping
+
+    """
+
+    def __init__(self, ring, seconds=2, max_bytes=4 * 2 ** 20, jpeg_quality=80):
+        Thread.__init__(self, name="PreRollBuffer")
+
+        self.ring = ring
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.jpeg_quality = jpeg_quality
+
+        self.frames = collections.deque()
+        self.bytes = 0
+        self.raw_bytes = 0
+        self.last_seq = -1
+
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    def run(self):
+
+        while not self.stopped():
+            record = self.ring.wait_for_frame(self.last_seq, timeout=1)
+            if record is None:
+                continue
+
+            ret, data = cv2.imencode(".jpg", record.bgr, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+            # the frame has been overwritten while encoding
+            if not ret or not record.valid():
+                continue
+
+            self.push(record.seq, record.timestamp, data, record.bgr.nbytes)
+
+    def push(self, seq, timestamp, data, raw_size):
+        """Add a compressed frame, dropping the old ones out of the budget"""
+
+        with self.lock:
+            self.frames.append((seq, timestamp, data))
+            self.bytes += len(data)
+            self.raw_bytes += raw_size
+            self.last_seq = seq
+
+            while self.frames and (self.bytes > self.max_bytes or timestamp - self.frames[0][1] > self.seconds):
+                _, _, old = self.frames.popleft()
+                self.bytes -= len(old)
+                # the frames of a ring have all the same size
+                self.raw_bytes -= raw_size
+
+    def fill(self, session):
+        """Put the frames held, and the ones still in the ring after them, at the beginning of an empty session"""
+
+        with self.lock:
+            frames = list(self.frames)
+
+        for seq, timestamp, data in frames:
+            session.add_encoded(seq, timestamp, data)
+
+        # the frames committed since the last one encoded are still in the ring
+        first = frames[-1][0] + 1 if frames else self.ring.last_seq
+        for seq in range(first, self.ring.last_seq + 1):
+            record = self.ring.get(seq)
+            if record is not None:
+                session.add(record)
+
+        session.preroll_frames = len(session)
+
+    def compression_ratio(self):
+        """Return how many times the frames held are smaller than the raw ones"""
+
+        with self.lock:
+            if not self.bytes:
+                return 0
+            return self.raw_bytes / self.bytes
+
+    def stats(self):
+        """Return a string with the buffer metrics"""
+
+        with self.lock:
+            frames = len(self.frames)
+            seconds = self.frames[-1][1] - self.frames[0][1] if frames else 0
+            held = self.bytes
+
+        return str(frames) + " frames, " + str(round(seconds, 1)) + " s, " + str(
+            round(held / 2 ** 20, 2)) + "/" + str(round(self.max_bytes / 2 ** 20, 2)) + " MB, compression ratio " + str(
+            round(self.compression_ratio(), 1))
+
+    def stop(self):
+        self.stop_event.set()
+
+    def stopped(self):
+        return self.stop_event.is_set()
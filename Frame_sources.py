@@ -0,0 +1,289 @@
+import glob
+import os
+from time import sleep, time
+
+import cv2
+import numpy as np
+
+
+class FrameSource:
+    """Base class for the objects CamShotter takes frames from.
+    Every source returns bgr frames with the (height, width, channels) shape it has been built with, and writes them
+    into the out image when possible so that the FrameRing slots can be reused.
+
+    Attributes:
+        shape : the (height, width, channels) shape of the frames
+        fps : the rate at which the frames are returned, the sources pace themselves to it
+        speed : a multiplier for fps, use 0 to return frames as fast as possible
+        warmup : the seconds to wait after the first frame, used by cameras to adjust focus and brightness
+        frame_idx : the number of frames returned so far
+        start_time : the time the first frame has been returned
+
+    """
+
+    def __init__(self, shape, fps=20, speed=1):
+        self.shape = shape
+        self.fps = fps
+        self.speed = speed
+        self.warmup = 0
+
+        self.frame_idx = 0
+        self.start_time = None
+
+    def read(self, out=None):
+        """Return the tuple (ret, img) like VideoCapture.read, img is out when the frame could be written in it"""
+        raise NotImplementedError
+
+    def release(self):
+        """Free the source"""
+        pass
+
+    def is_opened(self):
+        """Check if frames can be read from the source"""
+        return True
+
+    def reopen(self):
+        """Try to recover the source after a failed read"""
+        sleep(1)
+
+    def pace(self):
+        """Sleep until the next frame is due, so that recorded sources play at fps*speed"""
+
+        if self.start_time is None:
+            self.start_time = time()
+
+        if self.speed > 0 and self.fps > 0:
+            due = self.start_time + self.frame_idx / (self.fps * self.speed)
+            delay = due - time()
+            if delay > 0:
+                sleep(delay)
+
+        self.frame_idx += 1
+
+    def fit(self, img, out=None):
+        """Resize img to the source shape, writing in out if given"""
+
+        size = (self.shape[1], self.shape[0])
+
+        if img.shape[:2] != self.shape[:2]:
+            return cv2.resize(img, size, dst=out)
+
+        if out is not None:
+            np.copyto(out, img)
+            return out
+
+        return img
+
+
+class DeviceSource(FrameSource):
+    """Frames from a V4L device (the usual usb camera)
+
+    Attributes:
+        cam_idx : the camera index, usually 0
+        CAM : the videoCapture object to take frames from the camera
+
+    """
+
+    def __init__(self, shape, cam_idx=0):
+        FrameSource.__init__(self, shape, fps=0)
+        self.warmup = 3
+
+        self.cam_idx = cam_idx
+        self.CAM = cv2.VideoCapture(self.cam_idx)
+        self.set_resolution()
+
+    def set_resolution(self):
+        """Ask the camera for frames with the source shape, so that they can be read in place"""
+        self.CAM.set(cv2.CAP_PROP_FRAME_WIDTH, self.shape[1])
+        self.CAM.set(cv2.CAP_PROP_FRAME_HEIGHT, self.shape[0])
+
+    def read(self, out=None):
+        if out is None:
+            return self.CAM.read()
+        return self.CAM.read(out)
+
+    def release(self):
+        self.CAM.release()
+
+    def is_opened(self):
+        return self.CAM.isOpened()
+
+    def reopen(self):
+        """Release the camera and open it again"""
+        # release the camera
+        self.CAM.release()
+        sleep(2)
+        # capture stream
+        self.CAM = cv2.VideoCapture(self.cam_idx)
+        self.set_resolution()
+        sleep(2)
+        # chech if camera is opened
+        if not self.CAM.isOpened():
+            self.CAM.open(self.cam_idx)
+
+
+class VideoFileSource(FrameSource):
+    """Frames from a recorded video, played at its native rate times speed
+
+    Attributes:
+        path : the path of the video file
+        loop : if True the video restarts when it ends
+        ended : True when the video ended and loop is False
+        CAM : the videoCapture object reading the file
+
+    """
+
+    def __init__(self, shape, path, speed=1, loop=True):
+        self.path = path
+        self.loop = loop
+        self.ended = False
+
+        self.CAM = cv2.VideoCapture(path)
+        fps = self.CAM.get(cv2.CAP_PROP_FPS)
+
+        FrameSource.__init__(self, shape, fps=fps if fps > 0 else 20, speed=speed)
+
+    def read(self, out=None):
+
+        if self.ended:
+            return False, None
+
+        self.pace()
+        ret, img = self.CAM.read()
+
+        # restart the video when it ends
+        if not ret and self.loop:
+            self.CAM.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, img = self.CAM.read()
+
+        if not ret:
+            self.ended = True
+            return False, None
+
+        return True, self.fit(img, out)
+
+    def release(self):
+        self.CAM.release()
+
+    def is_opened(self):
+        return self.CAM.isOpened()
+
+    def reopen(self):
+        """Open the file again, unless the video just ended"""
+
+        if self.ended:
+            sleep(1)
+            return
+
+        self.CAM.release()
+        self.CAM = cv2.VideoCapture(self.path)
+
+
+class ImageDirSource(FrameSource):
+    """Frames from a directory of images, sorted by name
+
+    Attributes:
+        images : the paths of the images
+        loop : if True the images restart from the first when they end
+
+    """
+
+    def __init__(self, shape, path, fps=20, speed=1, loop=True):
+        FrameSource.__init__(self, shape, fps=fps, speed=speed)
+
+        self.images = sorted(glob.glob(os.path.join(path, "*.png")) + glob.glob(os.path.join(path, "*.jpg")))
+        self.loop = loop
+
+    def read(self, out=None):
+
+        if not self.images or (not self.loop and self.frame_idx >= len(self.images)):
+            return False, None
+
+        image_path = self.images[self.frame_idx % len(self.images)]
+        self.pace()
+
+        img = cv2.imread(image_path)
+        if img is None:
+            return False, None
+
+        return True, self.fit(img, out)
+
+    def is_opened(self):
+        return len(self.images) > 0
+
+
+class SyntheticSource(FrameSource):
+    """Frames with a noisy static background crossed by moving rectangles, used to test the motion detection without a
+    camera. The objects cross the scene during the first half of every cycle, then the scene stays still
+
+    Attributes:
+        objects : the number of moving rectangles
+        cycle : the number of frames of a cycle
+        background : the static background image
+        noise : a few noise images added to the background to emulate the sensor noise
+
+    """
+
+    def __init__(self, shape, fps=20, speed=1, objects=1, cycle=200, seed=0):
+        FrameSource.__init__(self, shape, fps=fps, speed=speed)
+
+        self.objects = objects
+        self.cycle = cycle
+
+        height, width = shape[:2]
+        rand = np.random.RandomState(seed)
+
+        # a smooth gradient with some texture
+        gradient = np.linspace(110, 170, width, dtype=np.float32)[None, :] * np.ones((height, 1), np.float32)
+        texture = cv2.blur(rand.uniform(-30, 30, (height, width)).astype(np.float32), (9, 9))
+        background = np.clip(gradient + texture, 0, 255).astype(np.uint8)
+        self.background = cv2.cvtColor(background, cv2.COLOR_GRAY2BGR)
+
+        self.noise = [rand.randint(-4, 5, shape).astype(np.int16) for _ in range(4)]
+
+    def read(self, out=None):
+
+        idx = self.frame_idx
+        self.pace()
+
+        height, width = self.shape[:2]
+        noisy = self.background.astype(np.int16) + self.noise[idx % len(self.noise)]
+
+        if out is None:
+            out = np.empty(self.shape, dtype=np.uint8)
+        np.clip(noisy, 0, 255, out=noisy)
+        out[...] = noisy
+
+        # move the objects during the first half of the cycle
+        step = idx % self.cycle
+        half = self.cycle // 2
+        if step < half:
+            for obj in range(self.objects):
+                obj_w = width // 6
+                obj_h = height // 2 - obj * height // 10
+                x = int((width + obj_w) * step / half) - obj_w
+                if obj % 2:
+                    x = width - x - obj_w
+                y = height // 4 + obj * height // 10
+                color = (20 + 15 * obj, 10 + 10 * obj, 30)
+                cv2.rectangle(out, (x, y), (x + obj_w, y + obj_h), color, -1)
+
+        return True, out
+
+
+def make_source(source_type, shape, path="", cam_idx=0, speed=1, fps=20):
+    """Build the frame source named by source_type, one of device, video, images, synthetic"""
+
+    if source_type == "device":
+        return DeviceSource(shape, cam_idx)
+
+    elif source_type == "video":
+        return VideoFileSource(shape, path, speed=speed)
+
+    elif source_type == "images":
+        return ImageDirSource(shape, path, fps=fps, speed=speed)
+
+    elif source_type == "synthetic":
+        return SyntheticSource(shape, fps=fps, speed=speed)
+
+    raise ValueError("Unknown frame source " + str(source_type))
@@ -0,0 +1,304 @@
+import cv2
+import numpy as np
+
+
+class HistogramIndex:
+    """Index over the stored histograms so that a face is compared only with the samples most similar to it instead of
+    all of them. The square roots of the histograms (under which the euclidean distance behaves like the chi-square one)
+    are projected on dims random directions, and the projected samples are clustered with k-means in clusters of about
+    cluster_size samples. A query is compared with the centroids, cheap, and then only the samples of the probes nearest
+    clusters are candidates for the exact chi-square comparison.
+    New samples are added to their nearest cluster, the clusters are computed again once the samples have doubled since
+    the last time. The index is never changed once built, updated returns a new one, so it can be used while the model
+    is being updated
+
+    Attributes:
+        cluster_size : the mean number of samples in a cluster
+        probes : the number of clusters whose samples are compared with a query
+        dims : the number of random directions the histograms are projected on
+        iterations : the k-means iterations
+        seed : the seed of the random projection and of the k-means initialization
+        chunk_size : the number of histograms projected at once, so that a memory mapped model is never copied whole
+        projection : the (bins,dims) projection matrix
+        centroids : the (clusters,dims) centroids of the clusters
+        members : the array of the indices of the samples of every cluster
+        size : the number of samples indexed
+        built_size : the number of samples when the clusters have been computed
+
+    """
+
+    def __init__(self, cluster_size=64, probes=4, dims=128, iterations=5, seed=0, chunk_size=4096):
+        self.cluster_size = cluster_size
+        self.probes = probes
+        self.dims = dims
+        self.iterations = iterations
+        self.seed = seed
+        self.chunk_size = chunk_size
+
+        self.projection = None
+        self.centroids = np.zeros((0, dims), dtype=np.float32)
+        self.members = []
+        self.size = 0
+        self.built_size = 0
+
+    def project(self, histograms):
+        """Return the (samples,dims) projection of the square roots of the histograms"""
+
+        if self.projection is None or self.projection.shape[0] != histograms.shape[1]:
+            rng = np.random.RandomState(self.seed)
+            self.projection = (rng.standard_normal((histograms.shape[1], self.dims)) / np.sqrt(self.dims)).astype(
+                np.float32)
+
+        projected = np.empty((len(histograms), self.dims), dtype=np.float32)
+        for start in range(0, len(histograms), self.chunk_size):
+            projected[start:start + self.chunk_size] = np.sqrt(histograms[start:start + self.chunk_size]).dot(
+                self.projection)
+
+        return projected
+
+    def nearest(self, points, count=1):
+        """Return the (points,count) indices of the nearest centroids to the projected points"""
+
+        distances = (self.centroids ** 2).sum(axis=1)[None, :] - 2 * points.dot(self.centroids.T)
+
+        if count >= len(self.centroids):
+            return np.argsort(distances, axis=1)
+        return np.argpartition(distances, count - 1, axis=1)[:, :count]
+
+    def build(self, histograms):
+        """Cluster all the histograms"""
+
+        points = self.project(histograms)
+        count = int(np.ceil(len(points) / float(self.cluster_size)))
+
+        rng = np.random.RandomState(self.seed)
+        self.centroids = points[rng.choice(len(points), count, replace=False)]
+
+        for _ in range(self.iterations):
+            assigned = self.nearest(points)[:, 0]
+            sums = np.zeros(self.centroids.shape, dtype=np.float64)
+            np.add.at(sums, assigned, points)
+            sizes = np.bincount(assigned, minlength=count)
+            # the empty clusters keep their centroid
+            full = sizes > 0
+            self.centroids[full] = (sums[full] / sizes[full][:, None]).astype(np.float32)
+
+        assigned = self.nearest(points)[:, 0]
+        order = np.argsort(assigned, kind="mergesort")
+        bounds = np.cumsum(np.bincount(assigned, minlength=count))[:-1]
+        self.members = np.split(order, bounds)
+
+        self.size = len(points)
+        self.built_size = len(points)
+
+    def updated(self, histograms):
+        """Return a new index over histograms, the histograms indexed by this one followed by the new ones"""
+
+        index = HistogramIndex(self.cluster_size, self.probes, self.dims, self.iterations, self.seed, self.chunk_size)
+
+        # too many samples added since the clustering, or nothing to add the new ones to
+        if self.built_size == 0 or len(histograms) > 2 * self.built_size:
+            index.build(histograms)
+            return index
+
+        index.projection = self.projection
+        index.centroids = self.centroids
+        index.members = list(self.members)
+        index.size = len(histograms)
+        index.built_size = self.built_size
+
+        if len(histograms) > self.size:
+            new = np.arange(self.size, len(histograms))
+            assigned = self.nearest(self.project(histograms[self.size:]))[:, 0]
+            for cluster in np.unique(assigned):
+                index.members[cluster] = np.concatenate((index.members[cluster], new[assigned == cluster]))
+
+        return index
+
+    def candidates(self, queries):
+        """Return, for every query histogram, the array of the indices of the samples to compare it with, all of them when
+        the nearest clusters are empty"""
+
+        nearest = self.nearest(self.project(queries), self.probes)
+
+        result = []
+        for clusters in nearest:
+            candidates = np.concatenate([self.members[cluster] for cluster in clusters])
+            result.append(candidates if len(candidates) else np.arange(self.size))
+
+        return result
+
+
+class LbphEngine:
+    """Local binary patterns histograms face recognizer working on a whole batch of faces at once with numpy, an
+    alternative to the cv2.face LBPH recognizer which predicts one face per call.
+    The model is the same one OpenCV uses: the circular LBP codes (bilinear interpolation of the neighbours) of the
+    grayscaled faces, a normalized histogram of the codes for every cell of a grid_x x grid_y grid, and the alternative
+    chi-square distance between the histograms, so the distances are comparable with the cv2.face ones.
+    The faces of a batch are resized to size and stacked, the codes and the histograms of all of them are computed with
+    array operations and compared with the stored histograms in blocks of block_size values. Once there are
+    index_samples samples a HistogramIndex chooses the ones each face is compared with, so the prediction time stays
+    about the same as the model grows
+
+    Attributes:
+        radius : the radius of the circle of the neighbours
+        neighbors : the number of neighbours, the histograms have 2^neighbors bins per cell
+        grid_x : the number of cells in a row
+        grid_y : the number of cells in a column
+        size : the (width,height) the faces are resized to
+        block_size : the maximum number of values of the (queries,samples,bins) blocks of the distance computation
+        index_samples : the number of samples from which the HistogramIndex is used, 0 to never use it
+        index : the empty HistogramIndex with the index parameters
+        model : the tuple (histograms, labels, index) of the stored samples, replaced as a whole when the model changes.
+            index is None below index_samples
+
+    """
+
+    def __init__(self, radius=1, neighbors=8, grid_x=8, grid_y=8, size=(200, 200), block_size=2 ** 20,
+                 index_samples=1024):
+        self.radius = radius
+        self.neighbors = neighbors
+        self.grid_x = grid_x
+        self.grid_y = grid_y
+        self.size = size
+        self.block_size = block_size
+        self.index_samples = index_samples
+        self.index = HistogramIndex()
+
+        self.model = (np.zeros((0, self.bins()), dtype=np.float32), np.zeros(0, dtype=np.int32), None)
+
+        # position and bilinear weights of every neighbour
+        self.offsets = []
+        for n in range(neighbors):
+            x = radius * np.cos(2 * np.pi * n / neighbors)
+            y = -radius * np.sin(2 * np.pi * n / neighbors)
+            fx, fy = int(np.floor(x)), int(np.floor(y))
+            cx, cy = int(np.ceil(x)), int(np.ceil(y))
+            tx, ty = x - fx, y - fy
+            self.offsets.append(((fy, fx, (1 - tx) * (1 - ty)), (fy, cx, tx * (1 - ty)), (cy, fx, (1 - tx) * ty),
+                                 (cy, cx, tx * ty)))
+
+    def bins(self):
+        """Return the length of the histogram of a face"""
+        return self.grid_x * self.grid_y * 2 ** self.neighbors
+
+    def samples(self):
+        """Return the number of stored samples"""
+        return len(self.model[1])
+
+    def stack(self, faces):
+        """Return the faces grayscaled and resized as a (faces,height,width) float array"""
+
+        stack = np.empty((len(faces), self.size[1], self.size[0]), dtype=np.float32)
+        for idx, face in enumerate(faces):
+            if face.ndim == 3:
+                face = cv2.cvtColor(face, cv2.COLOR_BGR2GRAY)
+            if (face.shape[1], face.shape[0]) != self.size:
+                face = cv2.resize(face, self.size)
+            stack[idx] = face
+
+        return stack
+
+    def codes(self, stack):
+        """Return the LBP codes of the stacked faces, the border of radius pixels is dropped"""
+
+        r = self.radius
+        height, width = stack.shape[1] - 2 * r, stack.shape[2] - 2 * r
+        center = stack[:, r:r + height, r:r + width]
+
+        codes = np.zeros(center.shape, dtype=np.int32)
+        for n, corners in enumerate(self.offsets):
+            neighbour = np.zeros(center.shape, dtype=np.float32)
+            for dy, dx, weight in corners:
+                if weight:
+                    neighbour += weight * stack[:, r + dy:r + dy + height, r + dx:r + dx + width]
+            codes |= ((neighbour > center) | (np.abs(neighbour - center) < np.finfo(np.float32).eps)).astype(
+                np.int32) << n
+
+        return codes
+
+    def histograms(self, faces):
+        """Return the (faces,bins) matrix of the normalized spatial histograms of the faces"""
+
+        if len(faces) == 0:
+            return np.zeros((0, self.bins()), dtype=np.float32)
+
+        codes = self.codes(self.stack(faces))
+        patterns = 2 ** self.neighbors
+
+        # the cells, the pixels not filling a whole cell are dropped like OpenCV does
+        count = len(codes)
+        cell_h, cell_w = codes.shape[1] // self.grid_y, codes.shape[2] // self.grid_x
+        codes = codes[:, :cell_h * self.grid_y, :cell_w * self.grid_x]
+        codes = codes.reshape(count, self.grid_y, cell_h, self.grid_x, cell_w).transpose(0, 1, 3, 2, 4)
+        codes = codes.reshape(count, self.grid_y * self.grid_x, cell_h * cell_w)
+
+        # one bincount for all the cells of all the faces
+        cells = np.arange(count * self.grid_y * self.grid_x).reshape(count, -1, 1)
+        hist = np.bincount((codes + cells * patterns).ravel(), minlength=count * self.bins())
+
+        return (hist.reshape(count, self.bins()) / float(cell_h * cell_w)).astype(np.float32)
+
+    def distances(self, queries, histograms):
+        """Return the (queries,samples) matrix of the chi-square distances between the histograms"""
+
+        result = np.empty((len(queries), len(histograms)), dtype=np.float32)
+        if len(queries) == 0 or len(histograms) == 0:
+            return result
+
+        step = max(1, self.block_size // (len(queries) * histograms.shape[1]))
+        for start in range(0, len(histograms), step):
+            block = histograms[start:start + step]
+            diff = queries[:, None, :] - block[None, :, :]
+            total = queries[:, None, :] + block[None, :, :]
+            # empty bins in both histograms do not count
+            result[:, start:start + step] = 2 * (diff * diff / np.maximum(total, np.finfo(np.float32).tiny)).sum(
+                axis=2)
+
+        return result
+
+    def set_model(self, histograms, labels, index=None):
+        """Replace the model, index is the index of the old model to be updated if there is one"""
+
+        if 0 < self.index_samples <= len(labels):
+            index = (self.index if index is None else index).updated(histograms)
+        else:
+            index = None
+
+        self.model = (histograms, labels, index)
+
+    def update(self, faces, labels):
+        """Add the faces with their labels to the model"""
+
+        histograms = self.histograms(faces)
+        old_histograms, old_labels, index = self.model
+        self.set_model(np.concatenate((old_histograms, histograms)),
+                       np.concatenate((old_labels, np.asarray(labels, dtype=np.int32))), index)
+
+    def predict_histograms(self, queries):
+        """Return the arrays of the labels and distances of the nearest samples to the histograms, -1 and inf when the
+        model is empty"""
+
+        histograms, labels, index = self.model
+        if len(labels) == 0:
+            return np.full(len(queries), -1, dtype=np.int32), np.full(len(queries), np.inf, dtype=np.float32)
+
+        if index is None:
+            distances = self.distances(queries, histograms)
+            nearest = distances.argmin(axis=1)
+            return labels[nearest], distances[np.arange(len(queries)), nearest]
+
+        # exact comparison with the candidates only
+        best_labels = np.empty(len(queries), dtype=np.int32)
+        best_distances = np.empty(len(queries), dtype=np.float32)
+        for idx, candidates in enumerate(index.candidates(queries)):
+            distances = self.distances(queries[idx:idx + 1], histograms[candidates])[0]
+            nearest = distances.argmin()
+            best_labels[idx] = labels[candidates[nearest]]
+            best_distances[idx] = distances[nearest]
+
+        return best_labels, best_distances
+
+    def predict(self, faces):
+        """Return the arrays of the labels and distances of the nearest samples to the faces"""
+        return self.predict_histograms(self.histograms(faces))
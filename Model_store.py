@@ -0,0 +1,161 @@
+import logging
+import os
+import struct
+import threading
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger('motionlog')
+
+
+class ModelStore:
+    """Binary file with the samples of the LbphEngine model, loaded with a memory map instead of being parsed and
+    written only at the end when new samples are added.
+    The file is a header_size bytes header followed by one row per sample, the label as an int32 and the histogram as
+    bins float32. The header holds the LBP parameters and the number of committed samples: new rows are written after
+    the committed ones and synced, then the header is rewritten with the new count and synced again. A crash before the
+    header is written leaves the rows beyond the count, which are ignored and overwritten by the next append
+
+    Attributes:
+        path : the path of the model file
+        header_format : the struct format of the header, magic, params and count
+        header_size : the bytes of the header
+        magic : the bytes at the start of the file
+        params : the (radius, neighbors, grid_x, grid_y) of the histograms
+        bins : the length of the histograms
+        count : the number of committed samples
+        lock : lock for the appends
+
+    """
+
+    def __init__(self, path, radius=1, neighbors=8, grid_x=8, grid_y=8):
+        self.path = path
+        self.header_format = "<8sIIIIQ"
+        self.header_size = 64
+        self.magic = b"LBPHSTR1"
+        self.params = (radius, neighbors, grid_x, grid_y)
+        self.bins = grid_x * grid_y * 2 ** neighbors
+        self.count = 0
+        self.lock = threading.Lock()
+
+        if os.path.exists(self.path):
+            self.read_header()
+        else:
+            self.create()
+
+    def row_type(self):
+        """Return the numpy dtype of a sample"""
+        return np.dtype([("label", "<i4"), ("histogram", "<f4", (self.bins,))])
+
+    def header(self):
+        """Return the header bytes"""
+
+        header = struct.pack(self.header_format, self.magic, *(self.params + (self.count,)))
+        return header + b"\0" * (self.header_size - len(header))
+
+    def create(self):
+        """Write an empty model"""
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(self.header())
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+
+    def read_header(self):
+        """Read the committed count, raise ValueError if the file is not a model with the same parameters or it is shorter
+        than the committed samples"""
+
+        with open(self.path, "rb") as file:
+            header = file.read(struct.calcsize(self.header_format))
+
+        try:
+            values = struct.unpack(self.header_format, header)
+        except struct.error:
+            raise ValueError(self.path + " is not a face model")
+
+        if values[0] != self.magic:
+            raise ValueError(self.path + " is not a face model")
+        if values[1:5] != self.params:
+            raise ValueError(self.path + " has been saved with the LBP parameters " + str(values[1:5]))
+
+        if os.path.getsize(self.path) < self.header_size + values[5] * self.row_type().itemsize:
+            raise ValueError(self.path + " is truncated, " + str(values[5]) + " samples committed")
+
+        self.count = values[5]
+
+    def load(self):
+        """Return the (histograms, labels) of the committed samples, the histograms are memory mapped"""
+
+        if self.count == 0:
+            return np.zeros((0, self.bins), dtype=np.float32), np.zeros(0, dtype=np.int32)
+
+        rows = np.memmap(self.path, dtype=self.row_type(), mode="r", offset=self.header_size, shape=(self.count,))
+        return rows["histogram"], np.array(rows["label"], dtype=np.int32)
+
+    def append(self, histograms, labels):
+        """Add the samples to the model and commit them"""
+
+        if len(labels) == 0:
+            return
+
+        rows = np.empty(len(labels), dtype=self.row_type())
+        rows["label"] = labels
+        rows["histogram"] = histograms
+
+        with self.lock:
+            with open(self.path, "r+b") as file:
+                # the rows of an append which was not committed are overwritten
+                file.seek(self.header_size + self.count * self.row_type().itemsize)
+                file.write(rows.tobytes())
+                file.truncate()
+                file.flush()
+                os.fsync(file.fileno())
+
+                self.count += len(labels)
+                file.seek(0)
+                file.write(self.header())
+                file.flush()
+                os.fsync(file.fileno())
+
+    def move(self, path):
+        """Rename the model file to path, replacing the file there if any"""
+
+        with self.lock:
+            os.replace(self.path, path)
+            self.path = path
+
+    def migrate_yaml(self, yaml_path):
+        """Append the samples of a model saved by the cv2.face LBPH recognizer, return the number of samples added"""
+
+        storage = cv2.FileStorage(yaml_path, cv2.FILE_STORAGE_READ)
+        try:
+            # OpenCV 3.1 writes the fields at the top level, newer versions inside opencv_lbphfaces
+            node = storage.getNode("opencv_lbphfaces")
+            if node.empty():
+                node = storage.root()
+
+            params = tuple(int(node.getNode(name).real()) for name in ("radius", "neighbors", "grid_x", "grid_y"))
+            if params != self.params:
+                logger.warning("Cannot migrate " + yaml_path + ", LBP parameters " + str(params) + " instead of " + str(
+                    self.params))
+                return 0
+
+            node_histograms = node.getNode("histograms")
+            histograms = np.array([node_histograms.at(idx).mat().ravel() for idx in range(node_histograms.size())],
+                                  dtype=np.float32).reshape(-1, self.bins)
+            labels = node.getNode("labels").mat()
+            labels = np.zeros(0, dtype=np.int32) if labels is None else labels.ravel().astype(np.int32)
+        finally:
+            storage.release()
+
+        self.append(histograms, labels)
+        logger.info("Migrated " + str(len(labels)) + " samples from " + yaml_path + " to " + self.path)
+
+        return len(labels)
+
+    def size(self):
+        """Return the bytes of the committed model"""
+        return self.header_size + self.count * self.row_type().itemsize
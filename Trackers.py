@@ -0,0 +1,235 @@
+import cv2
+import numpy as np
+
+
+class FaceTracker:
+    """Follow the faces found by the cascade in the next frames with template matching, which is much cheaper than
+    running the cascade again. Every face is searched only in a window around its last position, a face whose best
+    match is below min_score is lost
+
+    Attributes:
+        min_score : the minimum normalized correlation for a face to be found again, (0,1)
+        search_margin : the search window is the last box enlarged by this fraction of its size on every side
+        templates : the grayscaled face images taken when the faces have been detected
+        boxes : the last known (x,y,w,h) of every face
+        lost : True if a face has been lost since the last detection
+
+    """
+
+    def __init__(self, min_score=0.6, search_margin=0.5):
+        self.min_score = min_score
+        self.search_margin = search_margin
+
+        self.templates = []
+        self.boxes = []
+        self.lost = False
+
+    def start(self, gray, faces):
+        """Start tracking the faces (x,y,w,h) detected in gray, faces can be None"""
+
+        self.templates = []
+        self.boxes = []
+        self.lost = False
+
+        if faces is None:
+            return
+
+        for (x, y, w, h) in faces:
+            self.templates.append(gray[y:y + h, x:x + w].copy())
+            self.boxes.append((int(x), int(y), int(w), int(h)))
+
+    def update(self, gray):
+        """Look for the tracked faces in gray and return their boxes like the cascade does (None when there are no
+        faces). The faces not found are dropped and lost is set"""
+
+        height, width = gray.shape[:2]
+
+        templates = []
+        boxes = []
+        for template, (x, y, w, h) in zip(self.templates, self.boxes):
+            margin_w = int(w * self.search_margin)
+            margin_h = int(h * self.search_margin)
+            x1, y1 = max(0, x - margin_w), max(0, y - margin_h)
+            x2, y2 = min(width, x + w + margin_w), min(height, y + h + margin_h)
+
+            # the face went out of the frame
+            if x2 - x1 < w or y2 - y1 < h:
+                self.lost = True
+                continue
+
+            scores = cv2.matchTemplate(gray[y1:y2, x1:x2], template, cv2.TM_CCOEFF_NORMED)
+            _, score, _, (best_x, best_y) = cv2.minMaxLoc(scores)
+
+            if score < self.min_score:
+                self.lost = True
+                continue
+
+            templates.append(template)
+            boxes.append((x1 + best_x, y1 + best_y, w, h))
+
+        self.templates = templates
+        self.boxes = boxes
+
+        if len(boxes) > 0:
+            return np.array(boxes)
+
+        return None
+
+
+class MotionTrack:
+    """An object followed by the MotionTracker
+
+    Attributes:
+        track_id : the number of the object, unique for the tracker
+        history : the (seq, timestamp, x, y, w, h) of every frame the object has been matched in
+        missed : the frames in a row the object has not been matched in
+
+    """
+
+    def __init__(self, track_id, seq, timestamp, box):
+        self.track_id = track_id
+        self.history = [(seq, timestamp) + tuple(int(v) for v in box)]
+        self.missed = 0
+
+    def box(self):
+        """Return the last (x,y,w,h) of the object"""
+        return self.history[-1][2:]
+
+    def add(self, seq, timestamp, box):
+        """Add the box the object has been matched to"""
+        self.history.append((seq, timestamp) + tuple(int(v) for v in box))
+        self.missed = 0
+
+    def trajectory(self):
+        """Return the centers of the object as a (frames,2) array"""
+
+        boxes = np.array([entry[2:] for entry in self.history], dtype=np.float64)
+        return boxes[:, :2] + boxes[:, 2:] / 2
+
+    def direction(self, window=10):
+        """Return the tuple (incoming, left) over the last window frames: the object is incoming when its area grows
+        and goes left when its center moves left"""
+
+        first = self.history[max(0, len(self.history) - window)]
+        last = self.history[-1]
+
+        incoming = first[4] * first[5] < last[4] * last[5]
+        left = first[2] + first[4] / 2 > last[2] + last[4] / 2
+
+        return incoming, left
+
+    def duration(self):
+        """Return the seconds the object has been followed for"""
+        return self.history[-1][1] - self.history[0][1]
+
+
+class MotionTracker:
+    """Associate the motion boxes of consecutive frames to the objects seen before, so that every object has its own
+    trajectory and direction. The boxes are matched by intersection over union, or by the distance of their centers
+    when they do not overlap (fast objects), computing all the pairs at once with numpy. An object not matched for
+    more than max_missed frames is finished
+
+    Attributes:
+        min_iou : the minimum intersection over union for a box to be matched by overlap
+        max_distance : the maximum distance in pixels between the centers for a box to be matched by distance
+        max_missed : the frames an object can be missing before being finished
+        tracks : the objects being followed
+        finished : the objects not followed anymore
+        next_id : the id of the next object
+
+    """
+
+    def __init__(self, min_iou=0.1, max_distance=120, max_missed=5):
+        self.min_iou = min_iou
+        self.max_distance = max_distance
+        self.max_missed = max_missed
+
+        self.tracks = []
+        self.finished = []
+        self.next_id = 1
+
+    def reset(self):
+        """Forget all the objects"""
+
+        self.tracks = []
+        self.finished = []
+        self.next_id = 1
+
+    def scores(self, boxes):
+        """Return the (tracks, boxes) matrix of the matching scores, the iou when the boxes overlap enough otherwise a
+        negative score growing with the distance of the centers. Pairs that cannot match are -inf"""
+
+        old = np.array([track.box() for track in self.tracks], dtype=np.float64)
+        new = np.array(boxes, dtype=np.float64)
+
+        # corners, every old box against every new one
+        old_x2, old_y2 = old[:, 0] + old[:, 2], old[:, 1] + old[:, 3]
+        new_x2, new_y2 = new[:, 0] + new[:, 2], new[:, 1] + new[:, 3]
+
+        inter_w = np.minimum(old_x2[:, None], new_x2[None, :]) - np.maximum(old[:, 0][:, None], new[:, 0][None, :])
+        inter_h = np.minimum(old_y2[:, None], new_y2[None, :]) - np.maximum(old[:, 1][:, None], new[:, 1][None, :])
+        inter = np.clip(inter_w, 0, None) * np.clip(inter_h, 0, None)
+        union = (old[:, 2] * old[:, 3])[:, None] + (new[:, 2] * new[:, 3])[None, :] - inter
+        iou = inter / np.maximum(union, 1)
+
+        old_centers = old[:, :2] + old[:, 2:] / 2
+        new_centers = new[:, :2] + new[:, 2:] / 2
+        distance = np.linalg.norm(old_centers[:, None, :] - new_centers[None, :, :], axis=2)
+
+        scores = np.where(iou >= self.min_iou, iou, -distance / self.max_distance)
+        scores[(iou < self.min_iou) & (distance > self.max_distance)] = -np.inf
+
+        return scores
+
+    def update(self, seq, timestamp, boxes):
+        """Match the (x,y,w,h) boxes of the frame seq to the objects and return the object of every box"""
+
+        matched = []
+        assigned = [None] * len(boxes)
+        unmatched = list(range(len(boxes)))
+
+        if self.tracks and boxes:
+            scores = self.scores(boxes)
+
+            # greedy assignment, best scores first
+            used_tracks = set()
+            used_boxes = set()
+            for flat in np.argsort(-scores, axis=None):
+                track_idx, box_idx = np.unravel_index(flat, scores.shape)
+                if scores[track_idx, box_idx] == -np.inf:
+                    break
+                if track_idx in used_tracks or box_idx in used_boxes:
+                    continue
+
+                used_tracks.add(track_idx)
+                used_boxes.add(box_idx)
+                self.tracks[track_idx].add(seq, timestamp, boxes[box_idx])
+                matched.append(self.tracks[track_idx])
+                assigned[box_idx] = self.tracks[track_idx]
+
+            unmatched = [idx for idx in unmatched if idx not in used_boxes]
+
+        # the objects not seen
+        tracks = []
+        for track in self.tracks:
+            if track not in matched:
+                track.missed += 1
+                if track.missed > self.max_missed:
+                    self.finished.append(track)
+                    continue
+            tracks.append(track)
+
+        # the new objects
+        for box_idx in unmatched:
+            track = MotionTrack(self.next_id, seq, timestamp, boxes[box_idx])
+            self.next_id += 1
+            tracks.append(track)
+            assigned[box_idx] = track
+
+        self.tracks = tracks
+
+        return assigned
+
+    def all_tracks(self):
+        """Return all the objects, followed and finished, by id"""
+        return sorted(self.finished + self.tracks, key=lambda track: track.track_id)
@@ -0,0 +1,172 @@
+import logging
+import os
+from time import time
+
+import cv2
+
+from Event_pipeline import SessionWorker
+
+logger = logging.getLogger('motionlog')
+
+
+class EncodingPolicy:
+    """Choose the size and the frame rate of a video from its expected length, so that the file stays under a size
+    (and so an upload time) target. The frames are downscaled and decimated only as much as needed, the bytes per pixel
+    of the codec are estimated from the videos written
+
+    Attributes:
+        max_bytes : the maximum size of a video
+        uplink_rate : the upload speed in bytes per second, 0 when unknown
+        max_upload_seconds : the maximum seconds to upload a video, used when uplink_rate is known
+        scales : the resolution scales that can be used, from the best
+        max_decimation : the maximum number of frames merged in one, by keeping only the first
+        bytes_per_pixel : the estimated bytes per pixel of every frame, for the codec used
+        learning_rate : how fast bytes_per_pixel follows the videos written
+
+    """
+
+    def __init__(self, max_bytes=4 * 2 ** 20, uplink_rate=0, max_upload_seconds=20, bytes_per_pixel=0.01):
+        self.max_bytes = max_bytes
+        self.uplink_rate = uplink_rate
+        self.max_upload_seconds = max_upload_seconds
+        self.scales = (1, 0.75, 0.5)
+        self.max_decimation = 4
+        self.bytes_per_pixel = bytes_per_pixel
+        self.learning_rate = 0.3
+
+    def target_bytes(self):
+        """Return the maximum size of a video"""
+
+        if self.uplink_rate > 0:
+            return min(self.max_bytes, self.uplink_rate * self.max_upload_seconds)
+        return self.max_bytes
+
+    def choose(self, seconds, fps, size):
+        """Return the (fps, size, decimation) for a video expected to last seconds, recorded at fps with (width,height)
+        size. The biggest pixel rate expected to fit the target is chosen, the smallest one if none does"""
+
+        target = self.target_bytes()
+        best = None
+        smallest = None
+
+        for scale in self.scales:
+            scaled = (int(size[0] * scale) // 2 * 2, int(size[1] * scale) // 2 * 2)
+            for decimation in range(1, self.max_decimation + 1):
+                frames = seconds * fps / decimation
+                pixels = scaled[0] * scaled[1] * frames
+                choice = (fps / decimation, scaled, decimation)
+
+                if smallest is None or pixels < smallest[0]:
+                    smallest = (pixels, choice)
+
+                if pixels * self.bytes_per_pixel <= target and (best is None or pixels > best[0]):
+                    best = (pixels, choice)
+
+        return (best or smallest)[1]
+
+    def learn(self, file_bytes, frames, size):
+        """Update the bytes per pixel estimate with a video of frames with (width,height) size"""
+
+        if frames <= 0 or file_bytes <= 0:
+            return
+
+        observed = file_bytes / (frames * size[0] * size[1])
+        self.bytes_per_pixel += self.learning_rate * (observed - self.bytes_per_pixel)
+
+
+class VideoEncoder(SessionWorker):
+    """Thread writing the frames of a RecordingSession to a video file while they are being recorded, so that the video
+    is ready a few milliseconds after the recording ends instead of being encoded all at once afterwards.
+    The sessions are encoded in the order they are given. Before a frame is written the encoder waits, up to
+    overlay_timeout seconds, for the ready function to say that what has to be drawn on it is known. wait returns the
+    name of the video, None if the writing failed
+
+    Attributes:
+        codec : the fourcc of the videos
+        overlay_timeout : the seconds to wait for the overlays of a frame, then it is drawn with what is known
+        policy : the EncodingPolicy choosing the size and frame rate of the videos whose length is known
+        encoded : the number of videos written
+        last_stats : the metrics of the last video
+
+    """
+
+    def __init__(self, codec=0x00000021, overlay_timeout=2, policy=None):
+        SessionWorker.__init__(self, "VideoEncoder")
+
+        self.codec = codec
+        self.overlay_timeout = overlay_timeout
+        self.policy = EncodingPolicy() if policy is None else policy
+
+        self.encoded = 0
+        self.last_stats = "no videos yet"
+
+    def encode(self, session, video_name, fps, size, draw=None, ready=None, seconds=None):
+        """Queue a session to be written in video_name with the given fps and (width,height) size.
+        draw(session, idx, record) returns the idx-th frame with the overlays drawn on it, ready(session, idx, record)
+        tells if they are known already. When the maximum length of the recording in seconds is given, the size and
+        the frame rate are reduced by the policy if needed"""
+
+        self.submit(session, video_name, fps, size, draw, ready, seconds)
+
+    def process(self, session, video_name, fps, size, draw, ready, seconds):
+        """Write the frames of the session as they are stored, until the recording ends. Return the video name"""
+
+        decimation = 1
+        if seconds is not None:
+            fps, size, decimation = self.policy.choose(seconds, fps, size)
+
+        out = cv2.VideoWriter(video_name, self.codec, fps, size)
+
+        lag = 0
+        max_lag = 0
+        encode_time = 0
+        written = 0
+        lagging = 0
+        idx = 0
+        while not self.stopped():
+            if not session.wait_for_index(idx, timeout=1):
+                if session.ended:
+                    break
+                continue
+
+            # keep one frame every decimation
+            if idx % decimation:
+                idx += 1
+                continue
+
+            record = session.frame(idx)
+
+            # wait for the overlays to be known
+            if ready is not None:
+                session.wait_for(lambda: ready(session, idx, record), self.overlay_timeout)
+
+            start = time()
+            frame = record.bgr if draw is None else draw(session, idx, record)
+            if (frame.shape[1], frame.shape[0]) != size:
+                frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+            out.write(frame)
+            encode_time += time() - start
+
+            # how much the video is behind the camera, the pre-roll frames are old already
+            if idx >= session.preroll_frames:
+                frame_lag = time() - record.timestamp
+                lag += frame_lag
+                max_lag = max(max_lag, frame_lag)
+                lagging += 1
+            written += 1
+            idx += 1
+
+        out.release()
+
+        finalize = 0 if session.ended_at is None else time() - session.ended_at
+        file_bytes = os.path.getsize(video_name) if os.path.isfile(video_name) else 0
+        self.policy.learn(file_bytes, written, size)
+
+        self.encoded += 1
+        self.last_stats = str(written) + " frames " + str(size[0]) + "x" + str(size[1]) + " at " + str(
+            round(fps, 1)) + " fps, " + str(round(file_bytes / 2 ** 20, 2)) + " MB, encoded in " + str(
+            round(encode_time, 2)) + " s, lag behind capture " + str(round(lag / max(lagging, 1), 2)) + " s (max " + str(
+            round(max_lag, 2)) + " s), ready " + str(int(finalize * 1000)) + " ms after the recording ended"
+        logger.info("Video " + video_name + " encoded : " + self.last_stats)
+
+        return video_name
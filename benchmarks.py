@@ -0,0 +1,261 @@
+"""Benchmarks for the performance critical parts of the bot, run them with
+
+    python benchmarks.py [face cascade path]
+
+They do not need a camera nor telegram, the frames come from the synthetic frame source"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import cv2
+import numpy as np
+
+from Background_models import BACKGROUND_MODELS, make_background_model
+from Frame_sources import SyntheticSource
+from Lbph_engine import LbphEngine
+from Model_store import ModelStore
+
+SHAPE = (480, 640, 3)
+CASCADE_PATH = '/home/pi/InstallationPackages/opencv-3.1.0/data/lbpcascades/lbpcascade_frontalface.xml'
+
+
+def synthetic_gray(frames, resolution=(320, 240), blur=(5, 5), objects=1):
+    """Return frames synthetic grayscaled frames preprocessed like CamMovement.preprocess does"""
+
+    source = SyntheticSource(SHAPE, speed=0, objects=objects, cycle=100)
+
+    grays = []
+    for _ in range(frames):
+        _, img = source.read()
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        gray = cv2.resize(gray, resolution, interpolation=cv2.INTER_AREA)
+        grays.append(cv2.blur(gray, blur))
+
+    return grays
+
+
+def bench_background_models(frames=300):
+    """Print the per frame cost of every background model"""
+
+    print("\n=== Background models (" + str(frames) + " frames at 320x240) ===")
+    grays = synthetic_gray(frames)
+
+    for name in sorted(BACKGROUND_MODELS):
+        model = make_background_model(name)
+        model.reset(grays[0])
+
+        start = time()
+        foreground = 0
+        for gray in grays:
+            mask = model.apply(gray)
+            foreground += cv2.countNonZero(mask)
+        elapsed = time() - start
+
+        print(name.ljust(10) + str(round(1000 * elapsed / frames, 3)).rjust(8) + " ms per frame, foreground " + str(
+            round(100 * foreground / (frames * grays[0].size), 2)) + "%")
+
+
+def bench_face_detection(cascade_path=CASCADE_PATH, seconds=10, fps=20, workers=(1, 2, 3, 4)):
+    """Print the time to search for faces in a clip seconds long at fps, like CamMovement.scan_frame does, with
+    pools of different sizes. Every worker has its own cascade, as they cannot be shared between threads"""
+
+    if cv2.CascadeClassifier(cascade_path).empty():
+        print("\nCannot load the face cascade " + cascade_path + ", skipping the face detection benchmark")
+        return
+
+    frames = seconds * fps
+    print("\n=== Face detection (" + str(frames) + " frames at " + str(SHAPE[1]) + "x" + str(SHAPE[0]) + ") ===")
+
+    source = SyntheticSource(SHAPE, speed=0, objects=2, cycle=frames)
+    grays = []
+    for _ in range(frames):
+        _, img = source.read()
+        grays.append(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY))
+
+    cascades = threading.local()
+
+    def scan(gray):
+        if not hasattr(cascades, "frontal"):
+            cascades.frontal = cv2.CascadeClassifier(cascade_path)
+        faces = cascades.frontal.detectMultiScale(gray, scaleFactor=1.4, minNeighbors=3, minSize=(50, 50))
+        for (x, y, w, h) in faces:
+            cv2.Laplacian(gray[y:y + h, x:x + w], cv2.CV_64F).var()
+        return len(faces)
+
+    base = None
+    for size in workers:
+        with ThreadPoolExecutor(max_workers=size) as pool:
+            # load the cascades before timing
+            list(pool.map(scan, grays[:size]))
+
+            start = time()
+            list(pool.map(scan, grays))
+            elapsed = time() - start
+
+        base = base or elapsed
+        print(str(size).rjust(2) + " workers" + str(round(elapsed, 2)).rjust(8) + " s per clip, speedup " + str(
+            round(base / elapsed, 2)))
+
+
+def synthetic_faces(subjects, samples, size=(200, 200), noise=12, seed=0):
+    """Return (faces, labels) with samples grayscaled images for every subject, every subject is a random smooth
+    pattern (the same ones whatever the seed) and every sample of it has some noise and a small shift"""
+
+    patterns = np.random.RandomState(subjects)
+    rng = np.random.RandomState(seed)
+    faces = []
+    labels = []
+    for label in range(subjects):
+        base = cv2.resize(patterns.uniform(0, 255, (10, 10)).astype(np.float32), (size[0] + 8, size[1] + 8))
+        for _ in range(samples):
+            x, y = rng.randint(0, 9, 2)
+            face = base[y:y + size[1], x:x + size[0]] + rng.normal(0, noise, (size[1], size[0]))
+            faces.append(np.clip(face, 0, 255).astype(np.uint8))
+            labels.append(label)
+
+    return faces, labels
+
+
+def bench_lbph(subjects=20, samples=10, queries=100):
+    """Print the per face prediction time of the cv2.face LBPH recognizer, one face per call like
+    FaceRecognizer.predict, and of the numpy LbphEngine with the whole batch at once"""
+
+    print("\n=== LBPH prediction (" + str(subjects) + " subjects, " + str(subjects * samples) + " samples, " + str(
+        queries) + " faces) ===")
+
+    faces, labels = synthetic_faces(subjects, samples)
+    tests, truth = synthetic_faces(subjects, queries // subjects + 1, seed=1)
+    tests, truth = tests[:queries], np.array(truth[:queries])
+
+    recognizer = cv2.face.createLBPHFaceRecognizer()
+    start = time()
+    recognizer.train(faces, np.array(labels))
+    cv_train = time() - start
+
+    start = time()
+    cv_results = [recognizer.predict(face) for face in tests]
+    cv_elapsed = time() - start
+    cv_labels = np.array([result[0] for result in cv_results])
+    cv_distances = np.array([result[1] for result in cv_results])
+
+    engine = LbphEngine()
+    start = time()
+    engine.update(faces, labels)
+    np_train = time() - start
+
+    start = time()
+    np_labels, np_distances = engine.predict(tests)
+    np_elapsed = time() - start
+
+    print("opencv" + str(round(1000 * cv_elapsed / queries, 2)).rjust(8) + " ms per face, trained in " + str(
+        round(cv_train, 2)) + " s, accuracy " + str(round(100 * np.mean(cv_labels == truth), 1)) + "%")
+    print("numpy " + str(round(1000 * np_elapsed / queries, 2)).rjust(8) + " ms per face, trained in " + str(
+        round(np_train, 2)) + " s, accuracy " + str(round(100 * np.mean(np_labels == truth), 1)) + "%")
+    print("same label " + str(round(100 * np.mean(cv_labels == np_labels), 1)) + "%, max distance difference " + str(
+        round(float(np.abs(cv_distances - np_distances).max()), 3)))
+
+
+def bench_lbph_index(sizes=(500, 2000, 8000), subjects=40, queries=40, variation=4):
+    """Print the per face prediction time of the LbphEngine with and without the HistogramIndex as the model grows,
+    and how often the index finds the same label as the comparison with all the samples. The samples are the
+    histograms of synthetic faces with random variations, variation is the shape of their gamma noise (lower is more
+    different)"""
+
+    print("\n=== LBPH index scaling (" + str(subjects) + " subjects, " + str(queries) + " faces) ===")
+
+    engine = LbphEngine()
+    faces, labels = synthetic_faces(subjects, 1)
+    bases = engine.histograms(faces)
+    rng = np.random.RandomState(0)
+
+    def samples(count):
+        labels = rng.randint(0, subjects, count)
+        histograms = bases[labels] * rng.gamma(variation, 1.0 / variation, (count, bases.shape[1])).astype(np.float32)
+        return histograms, labels.astype(np.int32)
+
+    tests, truth = samples(queries)
+
+    for size in sizes:
+        histograms, labels = samples(size)
+
+        engine.index_samples = 0
+        engine.set_model(histograms, labels)
+        start = time()
+        exact_labels, exact_distances = engine.predict_histograms(tests)
+        exact = time() - start
+
+        engine.index_samples = 1
+        start = time()
+        engine.set_model(histograms, labels)
+        build = time() - start
+        start = time()
+        index_labels, index_distances = engine.predict_histograms(tests)
+        indexed = time() - start
+
+        print(str(size).rjust(6) + " samples : all " + str(round(1000 * exact / queries, 2)).rjust(8) + " ms, index " +
+              str(round(1000 * indexed / queries, 2)).rjust(7) + " ms per face (built in " + str(round(build, 2)) +
+              " s), same label " + str(round(100 * np.mean(index_labels == exact_labels), 1)) + "%, same distance " +
+              str(round(100 * np.mean(index_distances == exact_distances), 1)) + "%")
+
+
+def bench_model_store(samples=1000, subjects=20, added=10):
+    """Print the time to load a model of samples faces and to save added new ones, with the cv2.face YAML file and
+    with the ModelStore"""
+
+    print("\n=== Model store (" + str(samples) + " samples, " + str(added) + " added) ===")
+
+    faces, labels = synthetic_faces(subjects, samples // subjects)
+    new_faces, new_labels = synthetic_faces(subjects, 1, seed=1)
+    new_faces, new_labels = new_faces[:added], np.array(new_labels[:added])
+    directory = tempfile.mkdtemp()
+
+    try:
+        yaml_path = os.path.join(directory, "recognizer.yaml")
+        recognizer = cv2.face.createLBPHFaceRecognizer()
+        recognizer.train(faces, np.array(labels))
+        recognizer.save(yaml_path)
+
+        start = time()
+        recognizer = cv2.face.createLBPHFaceRecognizer()
+        recognizer.load(yaml_path)
+        yaml_load = time() - start
+
+        recognizer.update(new_faces, new_labels)
+        start = time()
+        recognizer.save(yaml_path)
+        yaml_save = time() - start
+
+        store_path = os.path.join(directory, "recognizer.lbph")
+        start = time()
+        ModelStore(store_path).migrate_yaml(yaml_path)
+        migration = time() - start
+
+        start = time()
+        store = ModelStore(store_path)
+        histograms, _ = store.load()
+        store_load = time() - start
+
+        new_histograms = LbphEngine().histograms(new_faces)
+        start = time()
+        store.append(new_histograms, new_labels)
+        store_save = time() - start
+
+        print("yaml " + str(round(yaml_load, 3)).rjust(9) + " s to load, " + str(round(yaml_save, 3)).rjust(7) +
+              " s to save, " + str(round(os.path.getsize(yaml_path) / 2 ** 20, 1)) + " MB")
+        print("store" + str(round(store_load, 3)).rjust(9) + " s to load, " + str(round(store_save, 3)).rjust(7) +
+              " s to save, " + str(round(store.size() / 2 ** 20, 1)) + " MB, migrated in " + str(round(migration, 2)) +
+              " s")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    bench_background_models()
+    bench_face_detection(*sys.argv[1:2])
+    bench_lbph()
+    bench_lbph_index()
+    bench_model_store()
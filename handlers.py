@@ -5,6 +5,7 @@ import logging
 import urllib.request
 import os, sys
 
+from Background_models import BACKGROUND_MODELS
 from Cam import MainClass
 from utils import add_id, elegible_user, read_token_psw
 
@@ -33,7 +34,7 @@ FLAG_SEND = """
 Here you can set the values of your flags, either <b>ON</b> or <b>OFF</b>
 -- <b>Motion Detection</b> : If set to <i>ON</i> the bot will notify, both with a message and with a video, you when a movement has been detected
 ---- <b>Video</b> : If set to <i>ON</i> the video you recieve from the <i>Motion Detection</i> above will highlith faces
----- <b>Movement square</b> : If set to <i>ON</i> the video will present green squares where the movement has been detected, (set it to off for faster computation)
+---- <b>Movement square</b> : If set to <i>ON</i> the video will present green squares where the movement has been detected, with the movement direction
 ---- <b>Face Photo</b> : If set to <i>ON</i> you will recieve a photo of the detected face with the video
 ---- <b>Face Reco(gnizer)</b> : If set to <i>ON</i> the program will try to guess the person face
 -- <b>Debug</b> : If set to <i>ON</i> you will recieve the images from the debug
@@ -241,6 +242,28 @@ def send_ground(bot, update):
     print("...Done")
 
 
+@elegible_user
+def set_bk_model(bot, update, args):
+    """Telegram command to change the background model"""
+    logger.info("background model command called")
+
+    if len(args) != 1 or args[0] not in BACKGROUND_MODELS:
+        update.message.reply_text("Current background model is " + cam.motion.bk_model_type + "\nUse /bkmodel name, where "
+                                  "name is one of : " + ", ".join(sorted(BACKGROUND_MODELS)))
+        return
+
+    cam.motion.set_background_model(args[0])
+    update.message.reply_text("Background model set to " + args[0])
+
+
+@elegible_user
+def send_stats(bot, update):
+    """Telegram command to send the performance metrics"""
+    logger.info("stats command called")
+
+    update.message.reply_text(cam.stats(), parse_mode="HTML")
+
+
 @elegible_user
 def help_bot(bot, update):
 
@@ -257,6 +280,8 @@ The avaiable commands are the following:
 - /logsend : send the logger file
 - /logdel : delete the log file
 - /bkground : send the background image
+- /bkmodel name : set the background model (static, average, mog2, knn)
+- /stats : send the performance metrics
 - /classify : classify the person face
 
 This bot has multiple functionalities:
@@ -3,7 +3,7 @@ from telegram.ext import (
 import logging
 from handlers import start, annulla, get_camshot, stream, disp, updater, \
     flag_setting_main, flag_setting_callback, reset_ground, stop_execution, send_log, send_ground, get_psw, delete_log, \
-    help_bot, predict_face
+    help_bot, predict_face, send_stats, set_bk_model
 
 #Implementing logger
 
@@ -38,8 +38,10 @@ if __name__ == "__main__":
     disp.add_handler(CommandHandler("stop",stop_execution))
     disp.add_handler(CommandHandler("logsend",send_log))
     disp.add_handler(CommandHandler("bkground",send_ground))
+    disp.add_handler(CommandHandler("bkmodel",set_bk_model,pass_args=True))
     disp.add_handler(CommandHandler("logdel",delete_log))
     disp.add_handler(CommandHandler("help",help_bot))
+    disp.add_handler(CommandHandler("stats",send_stats))
     #Adding CallcbackQuery
     disp.add_handler(CallbackQueryHandler(flag_setting_callback, pattern="/flag"))
     #adding message handler
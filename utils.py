@@ -15,6 +15,8 @@ stop - stop surveillance execution
 logsend - send the logger file
 logdel - delete the log file
 bkground - send the background image
+bkmodel - set the background model
+stats - send the performance metrics
 classify - classify the person face
 help - send the help text
 """